@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    Benchmark of the doctree assembly for synthetic projects.
+
+    Each project has chapters of which the toctree includes sections, and
+    the time and the peak memory of DocxBuilder.assemble_doctree are measured
+    for some project sizes. They should grow linearly with the project size.
+
+    usage: bench_assemble.py [documents]
+"""
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BASE_DIR)
+
+from sphinx.application import Sphinx # pylint: disable=wrong-import-position
+
+SECTIONS_PER_CHAPTER = 20
+
+CONF = '''
+extensions = ['docxbuilder']
+project = 'benchmark'
+'''
+
+SECTION = '''
+Section %(index)d
+===================
+
+Paragraph of section %(index)d with *emphasis* and ``literal``.
+
+* item 1
+* item 2
+
+.. code-block:: python
+
+   print(%(index)d)
+'''
+
+def write_file(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+
+def make_project(srcdir, num_documents):
+    write_file(os.path.join(srcdir, 'conf.py'), CONF)
+    num_chapters = max(1, num_documents // (SECTIONS_PER_CHAPTER + 1))
+    chapters = []
+    index = 0
+    for chapter in range(num_chapters):
+        sections = []
+        for _ in range(SECTIONS_PER_CHAPTER):
+            name = 'section%d' % index
+            write_file(
+                os.path.join(srcdir, name + '.rst'), SECTION % {'index': index})
+            sections.append(name)
+            index += 1
+        name = 'chapter%d' % chapter
+        write_file(os.path.join(srcdir, name + '.rst'), (
+            'Chapter %d\n==========\n\n.. toctree::\n\n' % chapter
+            + ''.join('   %s\n' % s for s in sections)))
+        chapters.append(name)
+    write_file(os.path.join(srcdir, 'index.rst'), (
+        'Benchmark\n=========\n\n.. toctree::\n\n'
+        + ''.join('   %s\n' % c for c in chapters)))
+    return 1 + num_chapters * (SECTIONS_PER_CHAPTER + 1)
+
+def measure(num_documents):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        srcdir = os.path.join(tmpdir, 'src')
+        os.mkdir(srcdir)
+        num_documents = make_project(srcdir, num_documents)
+        app = Sphinx(
+            srcdir, srcdir, os.path.join(tmpdir, 'out'),
+            os.path.join(tmpdir, 'doctrees'), 'docx',
+            status=None, warning=None, freshenv=True)
+        app.builder.read()
+        tracemalloc.start()
+        start = time.time()
+        app.builder.assemble_doctree('index', False)
+        elapsed = time.time() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return num_documents, elapsed, peak
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main():
+    max_documents = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    print('%10s %10s %14s' % ('documents', 'time (s)', 'peak (MiB)'))
+    for num_documents in (max_documents // 4, max_documents // 2, max_documents):
+        num_documents, elapsed, peak = measure(num_documents)
+        print('%10d %10.3f %14.1f' % (num_documents, elapsed, peak / 1048576.0))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    Micro-benchmark of the hot element constructors in docxbuilder.docx.
+
+    Each element is made by the generic make_element_tree from a tag list,
+    and by the constructor using the precompiled element templates.
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from docxbuilder.docx import docx # pylint: disable=wrong-import-position
+
+NUMBER = 20000
+
+def run_tree():
+    return docx.make_element_tree([
+        ['w:r'],
+        [['w:rPr'], [['w:rStyle', {'w:val': 'Emphasis'}]]],
+        [['w:t', 'some text', {}]],
+    ])
+
+def run():
+    return docx.make_run('some text', {'w:rStyle': {'w:val': 'Emphasis'}}, False)
+
+def paragraph_tree():
+    return docx.make_element_tree([
+        ['w:p'],
+        [['w:pPr'],
+         [['w:pStyle', {'w:val': 'BodyText'}]],
+         [['w:ind', {'w:leftChars': '0', 'w:left': '400'}]],
+         [['w:jc', {'w:val': 'left'}]],
+         [['w:keepNext']]],
+    ])
+
+def paragraph():
+    return docx.make_paragraph(400, None, 'BodyText', 'left', False, True, None)
+
+def row_tree():
+    return docx.make_element_tree([
+        ['w:tr'],
+        [['w:trPr'],
+         [['w:cnfStyle', {
+             'w:evenHBand': 'true', 'w:oddHBand': 'false',
+             'w:firstRow': 'false'}]],
+         [['w:cantSplit']]],
+    ])
+
+def row():
+    return docx.make_row(1, False, True, False, None)
+
+def cell_tree():
+    return docx.make_element_tree([
+        ['w:tc'],
+        [['w:tcPr'],
+         [['w:cnfStyle', {
+             'w:evenVBand': 'true', 'w:oddVBand': 'false',
+             'w:firstColumn': 'false'}]],
+         [['w:tcW', {'w:w': '25.000000%', 'w:type': 'pct'}]],
+         [['w:vAlign', {'w:val': 'top'}]]],
+    ])
+
+def cell():
+    return docx.make_cell(1, False, 0.25, 1, None, False, None, 'top')
+
+def picture_tree():
+    attrs = {'id': '1', 'name': 'image.png', 'descr': ''}
+    ext_attrs = {'cx': '3600000', 'cy': '1800000'}
+    return docx.make_element_tree([
+        ['w:r'],
+        [['w:rPr'], [['w:noProof']]],
+        [['w:drawing'],
+         [['wp:inline', {'distT': '0', 'distB': '0', 'distL': '0', 'distR': '0'}],
+          [['wp:extent', ext_attrs]],
+          [['wp:effectExtent', {'l': '25400', 't': '0', 'r': '0', 'b': '0'}]],
+          [['wp:docPr', attrs]],
+          [['wp:cNvGraphicFramePr'],
+           [['a:graphicFrameLocks', {'noChangeAspect': '1'}]]],
+          [['a:graphic'],
+           [['a:graphicData', {
+               'uri': 'http://schemas.openxmlformats.org/drawingml/2006/picture'}],
+            [['pic:pic'],
+             [['pic:nvPicPr'],
+              [['pic:cNvPr', attrs]],
+              [['pic:cNvPicPr'],
+               [['a:picLocks', {
+                   'noChangeAspect': '1', 'noChangeArrowheads': '1'}]]]],
+             [['pic:blipFill'],
+              [['a:blip', {'r:embed': 'rId1'}]],
+              [['a:srcRect']],
+              [['a:stretch'], [['a:fillRect']]]],
+             [['pic:spPr', {'bwMode': 'auto'}],
+              [['a:xfrm'],
+               [['a:off', {'x': '0', 'y': '0'}]],
+               [['a:ext', ext_attrs]]],
+              [['a:prstGeom', {'prst': 'rect'}], ['a:avLst']],
+              [['a:noFill']]]]]]]],
+    ])
+
+def picture():
+    return docx.make_inline_picture_run('rId1', 1, 'image.png', 10, 5, '')
+
+BENCHMARKS = [
+    ('run', run_tree, run),
+    ('paragraph', paragraph_tree, paragraph),
+    ('row', row_tree, row),
+    ('cell', cell_tree, cell),
+    ('inline picture', picture_tree, picture),
+]
+
+def main():
+    print('%-16s %12s %12s %8s' % ('element', 'tree (us)', 'template (us)', 'speedup'))
+    for name, tree_func, template_func in BENCHMARKS:
+        tree_time = min(timeit.repeat(tree_func, number=NUMBER, repeat=3))
+        template_time = min(
+            timeit.repeat(template_func, number=NUMBER, repeat=3))
+        print('%-16s %12.2f %12.2f %7.2fx' % (
+            name, tree_time / NUMBER * 1e6, template_time / NUMBER * 1e6,
+            tree_time / template_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    Benchmark of the relationship usage scan when saving a docx file.
+
+    The style file is given extra relationships which the body does not
+    reference, and a document of many paragraphs is saved. The former scan
+    evaluated an XPath over the whole document per relationship, so its time
+    grows with the relationship count, while ReferenceCollector walks
+    the document once.
+
+    usage: bench_rel_scan.py [paragraphs]
+"""
+from __future__ import print_function
+import io
+import os
+import sys
+import time
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BASE_DIR)
+
+# pylint: disable=wrong-import-position
+from create_style_file import create_style_file
+from docxbuilder.docx import docx
+
+STYLE_FILE = os.path.join(BASE_DIR, 'docxbuilder', 'docx', 'style.docx')
+REL_TYPE_HYPERLINK = (
+    'http://schemas.openxmlformats.org/officeDocument/2006/relationships/hyperlink')
+RELATIONSHIP_COUNTS = [10, 100, 1000]
+XPATH_SCAN_LIMIT = 100 # the former scan takes too long beyond this
+
+def make_composer(num_paragraphs, num_relationships):
+    composer = docx.DocxComposer(STYLE_FILE, False)
+    relationships = composer.style_docx.relationships
+    for index in range(num_relationships):
+        relationships.append(docx.make_element_tree([['pr:Relationship', {
+            'Id': 'rIdBench%d' % index,
+            'Type': REL_TYPE_HYPERLINK,
+            'Target': 'http://example.com/%d' % index,
+            'TargetMode': 'External',
+        }]]))
+    for index in range(num_paragraphs):
+        paragraph = docx.make_paragraph(
+            None, None, None, None, False, False, None)
+        paragraph.append(
+            docx.make_run('paragraph %d' % index, {}, False))
+        composer.docbody.append(paragraph)
+    return composer
+
+def xpath_scan(relationships, xml):
+    return [
+        rel.attrib for rel in docx.get_elements(relationships, 'pr:Relationship')
+        if docx.get_elements(xml, '(.//*[@*=$id])[1]', id=rel.get('Id'))
+    ]
+
+def collector_scan(relationships, xml):
+    collector = docx.ReferenceCollector(relationships)
+    collector.collect(xml)
+    return docx.collect_used_rel_attrs(
+        relationships, set(), collector.used_rel_ids)
+
+def measure(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+def main():
+    if not os.path.exists(STYLE_FILE):
+        create_style_file()
+    num_paragraphs = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    props = docx.classify_properties({'title': 'benchmark'})[0]
+    props['core'].setdefault('language', 'en')
+    print('%d paragraphs' % num_paragraphs)
+    print('%14s %12s %12s %12s' % (
+        'relationships', 'xpath (s)', 'collector (s)', 'save (s)'))
+    for num_relationships in RELATIONSHIP_COUNTS:
+        composer = make_composer(num_paragraphs, num_relationships)
+        relationships = composer.style_docx.relationships
+        if num_relationships <= XPATH_SCAN_LIMIT:
+            xpath_time = '%12.3f' % measure(
+                xpath_scan, relationships, composer.document)
+        else:
+            xpath_time = '%12s' % '-'
+        collector_time = measure(
+            collector_scan, relationships, composer.document)
+        save_time = measure(
+            composer.write_package, io.BytesIO(), False, props)
+        print('%14d %s %12.3f %12.3f' % (
+            num_relationships, xpath_time, collector_time, save_time))
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from sphinx.util.osutil import make_filename
 from docxbuilder.builder import DocxBuilder
+from docxbuilder.version import __version__
 
 
 def setup(app):
@@ -38,3 +39,32 @@ def setup(app):
     }, 'env')
     app.add_config_value('docx_style_names', {}, 'env')
     app.add_config_value('docx_nested_character_style', True, 'env')
+    app.add_config_value('docx_fragment_cache', False, '')
+    app.add_config_value('docx_streaming', False, '')
+    app.add_config_value('docx_lazy_assembly', False, '')
+    app.add_config_value('docx_image_max_dpi', 0, 'env')
+    app.add_config_value('docx_image_quality', 90, 'env')
+    app.add_config_value('docx_parallel_jobs', 0, '')
+    app.add_config_value('docx_parallel_chapters', False, '')
+    app.add_config_value('docx_math_jobs', 1, '')
+    app.add_config_value('docx_highlight_cache', False, '')
+    app.add_config_value('docx_trace_file', '', '')
+    app.add_config_value('docx_visitor_profile', 0, '')
+    app.add_config_value('docx_visitor_profile_file', '', '')
+    app.add_config_value('docx_memory_profile', 0, '')
+    app.add_config_value('docx_memory_profile_file', '', '')
+    app.add_config_value('docx_compression', {
+        'level': -1,
+        'media_level': -1,
+        'store_compressed_media': True,
+        'threads': 0,
+        'thread_min_size': 1024 * 1024,
+    }, '')
+
+    # The builder does not store any data in the environment, and generates
+    # docx files by itself.
+    return {
+        'version': __version__,
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
@@ -10,18 +10,63 @@
     :license: BSD, see LICENSE for details.
 """
 
+import collections
+import hashlib
+import json
 import os
+import time
 
 from docutils import nodes
-from docutils.io import BinaryFileOutput
 from sphinx import addnodes
 from sphinx.builders import Builder
 from sphinx.util import logging
 from sphinx.util.docutils import new_document
 from sphinx.util.osutil import ensuredir
+from sphinx.util.parallel import ParallelTasks, parallel_available
 
-from docxbuilder.writer import DocxWriter, DocxTranslator
+from docxbuilder import docx, trace
+from docxbuilder.cache import CountedCache, PersistentCache
+from docxbuilder.fragment import FRAGMENT_FORMAT_VERSION, count_chapters
+from docxbuilder.image import ImageInfoCache, ImageResampler
+from docxbuilder.omml import OmmlCache
+from docxbuilder.profiler import MemoryProfiler, VisitorProfiler
+from docxbuilder.version import __version__
+from docxbuilder.writer import (
+    DocxWriter, DocxTranslator, get_style_file_path)
 
+BUILD_INFO_FILENAME = '.docxbuildinfo'
+FRAGMENT_CACHE_FILENAME = 'docx_fragments.pickle'
+IMAGE_CACHE_FILENAME = 'docx_images.pickle'
+MATH_CACHE_FILENAME = 'docx_math.pickle'
+HIGHLIGHT_CACHE_FILENAME = 'docx_highlight.pickle'
+RESAMPLED_IMAGE_DIRNAME = 'docx_resampled'
+
+# Configuration values, other than docx_*, which affect the output
+DEPENDENT_CONFIG_NAMES = (
+    'highlight_language',
+    'highlight_options',
+    'language',
+    'numfig',
+    'numfig_format',
+    'pygments_style',
+    'trim_doctest_flags',
+)
+
+# Configuration values, which do not affect the output
+INDEPENDENT_CONFIG_NAMES = (
+    'docx_fragment_cache',
+    'docx_highlight_cache',
+    'docx_lazy_assembly',
+    'docx_math_jobs',
+    'docx_memory_profile',
+    'docx_memory_profile_file',
+    'docx_parallel_chapters',
+    'docx_parallel_jobs',
+    'docx_streaming',
+    'docx_trace_file',
+    'docx_visitor_profile',
+    'docx_visitor_profile_file',
+)
 
 class DocxBuilder(Builder):
     # pylint: disable=attribute-defined-outside-init
@@ -34,9 +79,67 @@ class DocxBuilder(Builder):
         self.imagedir = '_images'
         self._logger = logging.getLogger('docxbuilder')
         self._docx_documents = []
+        self._build_info = self._load_build_info()
+        self._traversed_docnames = collections.OrderedDict()
+        self.composer_templates = {} # (style file, coverpage) => composer
+        self.translated_chapter_keys = None # see _translate_chapters
+        if (self.config.docx_compression.get('threads', 0) > 0
+                and not docx.is_precompression_available()):
+            self._logger.warning(
+                'docx_compression threads are ignored because zipfile does '
+                'not allow writing parts deflated in advance')
+        self._create_caches()
+
+    def _create_caches(self):
+        """Create the caches, the image resampler and the profilers, which
+        are closed by _close_caches
+        """
+        if self.config.docx_trace_file:
+            trace.start()
+        else:
+            trace.stop() # The tracer may be left by the previous build
+        if (self.config.docx_visitor_profile
+                or self.config.docx_visitor_profile_file):
+            self.visitor_profiler = VisitorProfiler()
+        else:
+            self.visitor_profiler = None
+        if (self.config.docx_memory_profile
+                or self.config.docx_memory_profile_file):
+            self.memory_profiler = MemoryProfiler(
+                self.config.docx_memory_profile or 10)
+        else:
+            self.memory_profiler = None
+        if self.config.docx_fragment_cache:
+            self.fragment_cache = PersistentCache(
+                os.path.join(self.doctreedir, FRAGMENT_CACHE_FILENAME),
+                FRAGMENT_FORMAT_VERSION)
+        else:
+            self.fragment_cache = None
+        self.image_cache = ImageInfoCache(
+            os.path.join(self.doctreedir, IMAGE_CACHE_FILENAME))
+        if self.config.docx_image_max_dpi:
+            self.image_resampler = ImageResampler(
+                os.path.join(self.doctreedir, RESAMPLED_IMAGE_DIRNAME),
+                self.config.docx_image_max_dpi,
+                self.config.docx_image_quality, self.image_cache)
+        else:
+            self.image_resampler = None
+        self.math_cache = OmmlCache(
+            os.path.join(self.doctreedir, MATH_CACHE_FILENAME))
+        if self.config.docx_highlight_cache:
+            self.highlight_cache = CountedCache(
+                os.path.join(self.doctreedir, HIGHLIGHT_CACHE_FILENAME))
+        else:
+            self.highlight_cache = CountedCache()
 
     def get_outdated_docs(self):
-        return 'pass'
+        config_digest = self.get_config_digest()
+        for entry in self.config.docx_documents:
+            info = self._build_info.get(entry[1])
+            if (info is None
+                    or info.get('config') != config_digest
+                    or not os.path.exists(os.path.join(self.outdir, entry[1]))):
+                yield entry[0]
 
     def get_target_uri(self, docname, typ=None):
         return docname
@@ -59,20 +162,44 @@ class DocxBuilder(Builder):
         self.writer = DocxWriter(self)
 
     def assemble_doctree(self, master, toctree_only):
-        tree = self.env.get_doctree(master)
-        if toctree_only:
-            doc = new_document('docxbuilder/builder.py')
-            for toctree in tree.traverse(addnodes.toctree):
-                # ids is not assigned to toctree, but to the parent
-                toctree.get('ids').extend(toctree.parent.get('ids'))
-                doc.append(toctree)
-            tree = doc
-        tree = insert_all_toctrees(tree, master, self.env, [])
+        with trace.span('assemble_doctree', docname=master):
+            tree = self.env.get_doctree(master)
+            if toctree_only:
+                doc = new_document('docxbuilder/builder.py')
+                for toctree in tree.traverse(addnodes.toctree):
+                    # ids is not assigned to toctree, but to the parent
+                    toctree.get('ids').extend(toctree.parent.get('ids'))
+                    doc.append(toctree)
+                tree = doc
+            self._traversed_docnames = collections.OrderedDict()
+            with trace.span('insert_all_toctrees'):
+                tree = insert_all_toctrees(
+                    tree, master, self.env, self._traversed_docnames,
+                    self.config.docx_lazy_assembly)
         tree['docname'] = master
-        self._logger.info('')
         # TODO: Support cross references
         return tree
 
+    def load_start_of_file(self, node):
+        """Load the contents of the start_of_file node, which is inserted
+        by the lazy assembly, and return false if it is not to be written
+
+        The caller should remove the contents after writing them.
+        """
+        docname = node['docname']
+        if docname in self._traversed_docnames:
+            return False
+        self._traversed_docnames[docname] = None
+        try:
+            with trace.span('insert_all_toctrees', docname=docname):
+                subtree = insert_all_toctrees(
+                    self.env.get_doctree(docname), docname, self.env,
+                    self._traversed_docnames, True)
+        except Exception: # pylint: disable=broad-except
+            return False
+        node.children = subtree.children
+        return True
+
     def make_numfig_map(self):
         numfig_map = {}
         for docname, item in self.env.toc_fignumbers.items():
@@ -94,46 +221,371 @@ class DocxBuilder(Builder):
                 numsec_map[key] = num
         return numsec_map
 
-    def write(self, *_ignored): # pylint: disable=arguments-differ
+    def write(self, build_docnames, updated_docnames, method='update'):
+        # pylint: disable=arguments-differ,unused-argument
         docnames = self.env.all_docs
+        start_time = time.time()
 
         self._logger.info('preparing documents... ', nonl=True)
         self.prepare_writing(docnames)
         self._logger.info('done')
 
+        config_digest = self.get_config_digest()
+        entries = []
+        kept_fragment_keys = set()
         for entry in self._docx_documents:
-            start_doc, docname, props = entry[:3]
-            toctree_only = entry[3] if len(entry) > 3 else False
+            docname = entry[1]
+            if method != 'all' and self._is_up_to_date(docname, config_digest):
+                self._logger.info('skipping %s (up to date)' % docname)
+                kept_fragment_keys.update(
+                    self._build_info[docname].get('fragments', []))
+                continue
+            entries.append(entry)
+
+        nproc = self._get_parallel_jobs(len(entries))
+        if nproc > 1:
+            self._write_documents_in_parallel(entries, config_digest, nproc)
+        else:
+            for entry in entries:
+                docname, info, elapsed = self._write_document(
+                    entry, config_digest, True, True)
+                self._logger.info('done (%.2fs)' % elapsed)
+                self._build_info[docname] = info
+        self._save_build_info()
+        # The images and the fragments of the skipped files may be used in
+        # the next builds
+        writes_all = len(entries) == len(self._docx_documents)
+        self._close_caches(
+            kept_fragment_keys, start_time if writes_all else None)
+
+    def _close_caches(self, kept_fragment_keys, unused_since):
+        """Save the caches and the profiles, and terminate the process pools
+
+        The fragments of kept_fragment_keys are kept in the fragment cache,
+        and the downscaled images not used since unused_since are removed
+        unless it is None.
+        """
+        self.math_cache.close()
+        if self.image_resampler is not None:
+            self.image_resampler.close()
+            if unused_since is not None:
+                self.image_resampler.remove_unused(unused_since)
+        if self.fragment_cache is not None:
+            self.fragment_cache.save(kept_fragment_keys)
+        for name, cache in self._get_counted_caches():
+            cache.save()
+            if cache.hits or cache.misses:
+                self._logger.info('%s: %d hits, %d misses' % (
+                    name, cache.hits, cache.misses))
+        tracer = trace.stop()
+        if tracer is not None and self.config.docx_trace_file:
+            filename = os.path.join(self.outdir, self.config.docx_trace_file)
+            tracer.save(filename)
+            self._logger.info('trace is saved in %s' % filename)
+        if self.visitor_profiler is not None:
+            self._report_visitor_profile()
+        if self.memory_profiler is not None:
+            self._report_memory_profile()
+
+    def _write_documents_in_parallel(self, entries, config_digest, nproc):
+        self._logger.info(
+            'writing %d documents in %d processes' % (len(entries), nproc))
+
+        caches = [cache for _, cache in self._get_counted_caches()]
+
+        def write_process(entry):
+            # The counters inherited from the parent process are excluded
+            counters = [(cache.hits, cache.misses) for cache in caches]
+            trace.clear_events()
+            if self.visitor_profiler is not None:
+                self.visitor_profiler.clear()
+            if self.memory_profiler is not None:
+                self.memory_profiler.clear()
+            result = self._write_document(entry, config_digest, False)
+            if self.fragment_cache is not None:
+                fragments = self.fragment_cache.get_used_entries()
+            else:
+                fragments = None
+            cache_entries = [
+                (cache.get_used_entries(),
+                 cache.hits - hits, cache.misses - misses)
+                for cache, (hits, misses) in zip(caches, counters)]
+            if self.memory_profiler is not None:
+                memory_records = self.memory_profiler.get_records()
+            else:
+                memory_records = None
+            return result + (
+                fragments, cache_entries, trace.get_events(),
+                self._get_visitor_stats(), memory_records)
+
+        def on_written(_entry, result):
+            (docname, info, elapsed, fragments, cache_entries,
+             events, visitor_stats, memory_records) = result
+            trace.add_events(events)
+            if visitor_stats is not None:
+                self.visitor_profiler.update(visitor_stats)
+            if memory_records is not None:
+                self.memory_profiler.add_records(memory_records)
+            self._logger.info('%s done (%.2fs)' % (docname, elapsed))
+            self._build_info[docname] = info
+            if fragments is not None:
+                self.fragment_cache.update(fragments)
+            for cache, entries in zip(caches, cache_entries):
+                cache.update(*entries)
+
+        tasks = ParallelTasks(nproc)
+        for entry in entries:
+            tasks.add_task(write_process, entry, on_written)
+        tasks.join()
+
+    def _get_counted_caches(self):
+        """Return the names and the caches whose hits and misses are
+        reported
+        """
+        return [
+            ('image metadata cache', self.image_cache),
+            ('math cache', self.math_cache),
+            ('highlight cache', self.highlight_cache),
+        ]
 
-            self._logger.info('processing %s... ' % docname, nonl=True)
+    def _write_document(
+            self, entry, config_digest, shows_progress, parallel=False):
+        """Write a docx file for the docx_documents entry, and return
+        the docx filename, the build information and the elapsed time
+
+        If parallel is true, the chapters may be translated in parallel.
+        """
+        start_doc, docname, props = entry[:3]
+        toctree_only = entry[3] if len(entry) > 3 else False
+        memory_profiler = self.memory_profiler
+        if memory_profiler is not None:
+            memory_profiler.begin(docname)
+        with trace.span('write_document', filename=docname):
+            start_time = time.time()
+            if shows_progress:
+                self._logger.info('processing %s... ' % docname, nonl=True)
             doctree = self.assemble_doctree(start_doc, toctree_only)
+            if memory_profiler is not None:
+                memory_profiler.take_snapshot('assembly')
             self.doc_properties = props
-            self._logger.info('writing... ', nonl=True)
-            self.write_doc(docname, doctree)
-            self._logger.info('done')
+            if shows_progress:
+                self._logger.info('')
+            fragment_cache = self.fragment_cache
+            if fragment_cache is not None:
+                fragment_cache.start_recording()
+            try:
+                if parallel and self.config.docx_parallel_chapters:
+                    self._translate_chapters(doctree)
+                if shows_progress:
+                    self._logger.info('writing... ', nonl=True)
+                self.write_doc(docname, doctree)
+                if memory_profiler is not None:
+                    memory_profiler.take_snapshot('packaging')
+            finally:
+                self.fragment_cache = fragment_cache
+                self.translated_chapter_keys = None
+                if fragment_cache is not None:
+                    fragment_keys = fragment_cache.stop_recording()
+            docnames = [start_doc] + list(self._traversed_docnames)
+            info = {
+                'config': config_digest,
+                'docnames': docnames,
+                'digest': self._get_docnames_digest(docnames),
+            }
+            if fragment_cache is not None:
+                info['fragments'] = sorted(fragment_keys)
+        return docname, info, time.time() - start_time
+
+    def _translate_chapters(self, doctree):
+        """Translate the chapters of the doctree in parallel processes
+        into fragments in the fragment cache, which the translator for
+        the whole doctree inserts if it reaches the chapters in the same
+        states
+        """
+        num_chapters = count_chapters(doctree)
+        nproc = self._get_parallel_jobs(num_chapters)
+        if nproc < 2:
+            return
+        self._logger.info(
+            'translating %d chapters in %d processes' % (num_chapters, nproc))
+        if self.fragment_cache is None:
+            # Used only to pass the fragments to the translator
+            self.fragment_cache = PersistentCache(None)
+        chapter_keys = {}
+
+        def translate_process(chapters):
+            trace.clear_events()
+            if self.visitor_profiler is not None:
+                self.visitor_profiler.clear()
+            if self.memory_profiler is not None:
+                self.memory_profiler.clear()
+            used_keys = set(self.fragment_cache.get_used_entries())
+            translator = self.create_translator(doctree, self)
+            keys = translator.fragments.translate_chapters(chapters)
+            fragments = dict(
+                (key, fragment) for key, fragment
+                in self.fragment_cache.get_used_entries().items()
+                if key not in used_keys)
+            memory_records = None
+            if self.memory_profiler is not None:
+                self.memory_profiler.take_snapshot('chapter translation')
+                memory_records = self.memory_profiler.get_records()
+            return (keys, fragments, trace.get_events(),
+                    self._get_visitor_stats(), memory_records)
+
+        def on_translated(_chapters, result):
+            keys, fragments, events, visitor_stats, memory_records = result
+            trace.add_events(events)
+            if visitor_stats is not None:
+                self.visitor_profiler.update(visitor_stats)
+            if memory_records is not None:
+                self.memory_profiler.add_records(memory_records)
+            chapter_keys.update(keys)
+            self.fragment_cache.update(fragments)
+
+        tasks = ParallelTasks(nproc)
+        for index in range(nproc):
+            tasks.add_task(
+                translate_process, set(range(index, num_chapters, nproc)),
+                on_translated)
+        tasks.join()
+        self.translated_chapter_keys = chapter_keys
+
+    def _get_visitor_stats(self):
+        if self.visitor_profiler is None:
+            return None
+        return self.visitor_profiler.get_stats()
+
+    def _report_visitor_profile(self):
+        num_rows = self.config.docx_visitor_profile
+        if num_rows:
+            self._logger.info(
+                'visitor profile (top %d node classes by exclusive time):'
+                % num_rows)
+            for line in self.visitor_profiler.format_table(num_rows):
+                self._logger.info('  ' + line)
+        if self.config.docx_visitor_profile_file:
+            filename = os.path.join(
+                self.outdir, self.config.docx_visitor_profile_file)
+            self.visitor_profiler.save(filename)
+            self._logger.info('visitor profile is saved in %s' % filename)
+
+    def _report_memory_profile(self):
+        self.memory_profiler.stop()
+        if self.config.docx_memory_profile:
+            self._logger.info('memory profile:')
+            for line in self.memory_profiler.format_records():
+                self._logger.info('  ' + line)
+        if self.config.docx_memory_profile_file:
+            filename = os.path.join(
+                self.outdir, self.config.docx_memory_profile_file)
+            self.memory_profiler.save(filename)
+            self._logger.info('memory profile is saved in %s' % filename)
+
+    def _get_parallel_jobs(self, num_entries):
+        nproc = self.config.docx_parallel_jobs or self.app.parallel
+        if not parallel_available:
+            return 1
+        return min(nproc, num_entries)
 
     def write_doc(self, docname, doctree):
         outfilename = os.path.join(self.outdir, docname)
         ensuredir(os.path.dirname(outfilename))
-        destination = BinaryFileOutput(destination_path=outfilename)
-        self.writer.write(doctree, destination)
+        self.writer.save(doctree, outfilename)
 
     def finish(self):
         pass
 
-def insert_all_toctrees(tree, docname, env, traversed):
-    tree = tree.deepcopy()
+    def _load_build_info(self):
+        try:
+            with open(os.path.join(self.outdir, BUILD_INFO_FILENAME)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_build_info(self):
+        # Drop the information of the files removed from docx_documents
+        filenames = set(entry[1] for entry in self.config.docx_documents)
+        self._build_info = dict(
+            (filename, info) for filename, info in self._build_info.items()
+            if filename in filenames)
+        ensuredir(self.outdir)
+        with open(os.path.join(self.outdir, BUILD_INFO_FILENAME), 'w') as f:
+            json.dump(self._build_info, f, indent=1, sort_keys=True)
+
+    def _is_up_to_date(self, docname, config_digest):
+        """Return true if the docx file has been built from the same sources
+        """
+        info = self._build_info.get(docname)
+        if info is None or info.get('config') != config_digest:
+            return False
+        if not os.path.exists(os.path.join(self.outdir, docname)):
+            return False
+        return info.get('digest') == self._get_docnames_digest(
+            info.get('docnames', []))
+
+    def get_config_digest(self):
+        """Make a digest from the configuration values affecting the output
+        """
+        md5 = hashlib.md5()
+        md5.update(('version=%s\n' % __version__).encode('utf8'))
+        names = sorted(
+            name for name in self.config.values
+            if name.startswith('docx_') and name not in INDEPENDENT_CONFIG_NAMES)
+        names.extend(DEPENDENT_CONFIG_NAMES)
+        for name in names:
+            value = getattr(self.config, name, None)
+            md5.update(('%s=%r\n' % (name, value)).encode('utf8'))
+        stylefile = get_style_file_path(self)
+        try:
+            stat = os.stat(stylefile)
+            md5.update(('%s:%d:%d' % (
+                stylefile, stat.st_mtime, stat.st_size)).encode('utf8'))
+        except OSError:
+            pass
+        return md5.hexdigest()
+
+    def _get_docnames_digest(self, docnames):
+        """Make a digest from the states of the specified documents
+        """
+        md5 = hashlib.md5()
+        for docname in docnames:
+            if docname not in self.env.all_docs:
+                return None
+            secnumbers = self.env.toc_secnumbers.get(docname, {})
+            fignumbers = self.env.toc_fignumbers.get(docname, {})
+            md5.update(('%s:%r:%r:%r\n' % (
+                docname, self.env.all_docs[docname],
+                sorted(secnumbers.items()),
+                sorted((figtype, sorted(nums.items()))
+                       for figtype, nums in fignumbers.items()),
+            )).encode('utf8'))
+        return md5.hexdigest()
+
+def insert_all_toctrees(tree, docname, env, traversed, lazy=False):
+    """Insert the documents included by the toctrees into the tree
+
+    The tree is modified in place, so it must not be shared, such as one
+    returned by env.get_doctree. traversed is an ordered dictionary whose keys
+    are the names of the inserted documents.
+    If lazy is true, empty start_of_file nodes are inserted instead, and
+    the documents are loaded by DocxBuilder.load_start_of_file when written.
+    """
     env.apply_post_transforms(tree, docname)
-    for toctreenode in tree.traverse(addnodes.toctree):
-        nodeid = 'docx_expanded_toctree%d' % id(toctreenode)
+    for index, toctreenode in enumerate(tree.traverse(addnodes.toctree)):
+        nodeid = 'docx_expanded_toctree%d' % index
         newnodes = nodes.container(ids=[nodeid])
         toctreenode['docx_expanded_toctree_refid'] = nodeid
         includefiles = toctreenode['includefiles']
         for includefile in includefiles:
+            if lazy:
+                newnodes.append(addnodes.start_of_file(
+                    docname=includefile, docx_lazy=True))
+                continue
             if includefile in traversed:
                 continue
             try:
-                traversed.append(includefile)
+                traversed[includefile] = None
                 subtree = insert_all_toctrees(
                     env.get_doctree(includefile), includefile, env, traversed)
             except Exception: # pylint: disable=broad-except
@@ -142,6 +594,6 @@ def insert_all_toctrees(tree, docname, env, traversed):
             start_of_file.children = subtree.children
             newnodes.append(start_of_file)
         parent = toctreenode.parent
-        index = parent.index(toctreenode)
-        parent.insert(index + 1, newnodes)
+        position = parent.index(toctreenode)
+        parent.insert(position + 1, newnodes)
     return tree
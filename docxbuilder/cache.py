@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+    Caches of intermediate results, which are persisted across builds.
+"""
+
+import os
+import pickle
+
+from sphinx.util import logging
+from sphinx.util.osutil import ensuredir
+
+from docxbuilder.version import __version__
+
+
+# Version of the layout of the cache files
+CACHE_FORMAT_VERSION = 1
+
+
+def get_file_stat(filename):
+    """Return the mtime and size of the file, which change when it is updated,
+    or None if the file does not exist
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+class PersistentCache(object):
+    """Mapping from a key to a value, which is pickled in a file.
+
+    Only entries looked up or stored in the current build, and those
+    specified on saving, are saved, so that stale entries do not accumulate.
+    If filename is None, the entries are kept only in memory.
+
+    The file is ignored if it was saved by another version of docxbuilder,
+    or with another format_version, which is to be changed when the layout
+    of the values changes.
+    """
+
+    def __init__(self, filename, format_version=0):
+        self._filename = filename
+        self._header = (
+            CACHE_FORMAT_VERSION, __version__, format_version)
+        self._entries = None
+        self._used_entries = {}
+        self._recorded_keys = None
+
+    def get(self, key, default=None):
+        if self._recorded_keys is not None:
+            self._recorded_keys.add(key)
+        value = self._used_entries.get(key)
+        if value is not None:
+            return value
+        if self._entries is None:
+            self._entries = self._load()
+        value = self._entries.get(key)
+        if value is None:
+            return default
+        self._used_entries[key] = value
+        return value
+
+    def put(self, key, value):
+        if self._recorded_keys is not None:
+            self._recorded_keys.add(key)
+        self._used_entries[key] = value
+
+    def start_recording(self):
+        """Start recording the keys looked up or stored"""
+        self._recorded_keys = set()
+
+    def stop_recording(self):
+        """Stop recording the keys, and return the recorded keys"""
+        keys, self._recorded_keys = self._recorded_keys, None
+        return keys
+
+    def get_used_entries(self):
+        return dict(self._used_entries)
+
+    def update(self, entries):
+        self._used_entries.update(entries)
+
+    def save(self, kept_keys=()):
+        """Save the used entries, and the entries of kept_keys loaded from
+        the file
+        """
+        if self._filename is None:
+            return
+        entries = {}
+        if kept_keys:
+            if self._entries is None:
+                self._entries = self._load()
+            for key in kept_keys:
+                value = self._entries.get(key)
+                if value is not None:
+                    entries[key] = value
+        entries.update(self._used_entries)
+        ensuredir(os.path.dirname(self._filename))
+        try:
+            with open(self._filename, 'wb') as f:
+                pickle.dump(
+                    (self._header, entries), f, pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            logging.getLogger('docxbuilder').warning(
+                'Failed to save cache %s: %s' % (self._filename, e))
+
+    def _load(self):
+        if self._filename is None:
+            return {}
+        try:
+            with open(self._filename, 'rb') as f:
+                header, entries = pickle.load(f)
+        except Exception: # pylint: disable=broad-except
+            return {}
+        return entries if header == self._header else {}
+
+class CountedCache(object):
+    """Mapping kept in memory during a build, which counts the hits and
+    misses of lookups
+
+    If filename is not None, the entries are also persisted in the file.
+    """
+
+    def __init__(self, filename=None):
+        self._cache = PersistentCache(filename) if filename else None
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None and self._cache is not None:
+            value = self._cache.get(key)
+            if value is not None:
+                self._entries[key] = value
+        if value is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        if self._cache is not None:
+            self._cache.put(key, value)
+
+    def get_or_make(self, key, make):
+        """Return the value of the key, or store and return the value made
+        by make if the key is not found
+        """
+        # Subclasses may override get with another signature
+        value = CountedCache.get(self, key)
+        if value is None:
+            value = make()
+            self.put(key, value)
+        return value
+
+    def __contains__(self, key):
+        """Return true if the key is found, which is not counted"""
+        if key in self._entries:
+            return True
+        return self._cache is not None and self._cache.get(key) is not None
+
+    def get_used_entries(self):
+        if self._cache is None:
+            return {}
+        return self._cache.get_used_entries()
+
+    def update(self, entries, hits, misses):
+        """Merge the entries and the counters of another cache"""
+        self._entries.update(entries)
+        if self._cache is not None:
+            self._cache.update(entries)
+        self.hits += hits
+        self.misses += misses
+
+    def save(self):
+        if self._cache is not None:
+            self._cache.save()
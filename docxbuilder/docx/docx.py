@@ -17,15 +17,23 @@
 
 import copy
 import datetime
+import hashlib
 import io
 import os
 import posixpath
 import re
+import shutil
+import sys
+import tempfile
 import time
 import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
 import six
 from lxml import etree
 
+from docxbuilder.trace import NullSpan
+
 # All Word prefixes / namespace matches used in document.xml & core.xml.
 # LXML doesn't actually use prefixes (just the real namespace) , but these
 # make it easier to copy Word output more easily.
@@ -111,19 +119,38 @@ def norm_name(tagname):
           'ns:tag' --> '{namespace}tag'
           'tag' --> 'tag'
     '''
-    if tagname.startswith('{'):
-        return tagname
-    ns_name = tagname.split(':', 1)
-    if len(ns_name) > 1:
-        tagname = "{%s}%s" % (NSPREFIXES[ns_name[0]], ns_name[1])
-    return tagname
+    name = _NORMALIZED_NAMES.get(tagname)
+    if name is not None:
+        return name
+    name = tagname
+    if not tagname.startswith('{'):
+        ns_name = tagname.split(':', 1)
+        if len(ns_name) > 1:
+            name = "{%s}%s" % (NSPREFIXES[ns_name[0]], ns_name[1])
+    _NORMALIZED_NAMES[tagname] = name
+    return name
+
+_NORMALIZED_NAMES = {}
+
 
+_XPATHS = {}
+
+def compile_xpath(path):
+    '''
+       Get the XPath object for 'path', which is compiled only once.
+    '''
+    xpath = _XPATHS.get(path)
+    if xpath is None:
+        xpath = etree.XPath(path, namespaces=NSPREFIXES)
+        _XPATHS[path] = xpath
+    return xpath
 
-def get_elements(xml, path):
+def get_elements(xml, path, **variables):
     '''
        Get elements from a Element tree with 'path'.
+       'variables' are bound to the XPath variables in 'path'.
     '''
-    return xml.xpath(path, namespaces=NSPREFIXES)
+    return compile_xpath(path)(xml, **variables)
 
 
 def parse_tag_list(tag):
@@ -189,9 +216,67 @@ def make_element_tree(arg, _xmlns=None):
 
     return newele
 
+_ELEMENT_PROTOTYPES = {}
+_MAX_ELEMENT_PROTOTYPES = 4096
 
-def get_attribute(xml, path, name):
-    elems = get_elements(xml, path)
+def make_element(tagname, attributes=None, text=None, parent=None):
+    '''
+       Make the same element as make_element_tree([[tagname, text, attributes]]),
+       and append it to 'parent' if it is specified.
+       The element is copied from the prototype made for the same tag name
+       and attributes, which avoids normalizing names and namespaces.
+    '''
+    key = (tagname, tuple(attributes.items())) if attributes else tagname
+    prototype = _ELEMENT_PROTOTYPES.get(key)
+    if prototype is not None:
+        elem = copy.copy(prototype)
+    else:
+        elem = make_element_tree([[tagname, attributes or {}]])
+        if len(_ELEMENT_PROTOTYPES) < _MAX_ELEMENT_PROTOTYPES:
+            _ELEMENT_PROTOTYPES[key] = copy.copy(elem)
+    if text:
+        elem.text = text
+    if parent is not None:
+        parent.append(elem)
+    return elem
+
+class ElementPrototype(object):
+    '''
+       Element tree made by make_element_tree once, and copied on each use.
+       The attribute values written as '{key}' are replaced with
+       the values passed to make.
+    '''
+    _placeholder = re.compile(r'^\{(\w+)\}$')
+
+    def __init__(self, tree):
+        self._prototype = make_element_tree(tree)
+        self._slots = []
+        for index, elem in enumerate(self._prototype.iter()):
+            for name, value in elem.attrib.items():
+                match = self._placeholder.match(value)
+                if match:
+                    self._slots.append((index, name, match.group(1)))
+
+    def make(self, **values):
+        elem = copy.copy(self._prototype)
+        descendants = list(elem.iter())
+        for index, name, key in self._slots:
+            descendants[index].set(name, values[key])
+        return elem
+
+
+def copy_element(elem, elem_map):
+    '''
+       Deep copy the element, and map the original descendants to the copies
+    '''
+    if elem is None:
+        return None
+    new_elem = copy.deepcopy(elem)
+    elem_map.update(zip(elem.iter(), new_elem.iter()))
+    return new_elem
+
+def get_attribute(xml, path, name, **variables):
+    elems = get_elements(xml, path, **variables)
     if elems == []:
         return None
     return elems[0].attrib[norm_name(name)]
@@ -204,11 +289,25 @@ def get_max_attribute(elems, attribute, to_int=int):
         return 0
     return max(map(lambda e: to_int(e.get(attribute)), elems))
 
+def tostring(elem):
+    """Serialize the element to a byte string"""
+    return etree.tostring(elem)
+
 def fromstring(xml):
     """Parse string OOXML fragments"""
     ns = ' '.join('xmlns:%s="%s"' % (k, v) for k, v in NSPREFIXES.items())
     return etree.fromstring('<dummy %s>%s</dummy>' % (ns, xml)).getchildren()
 
+def get_file_digest(filename):
+    '''
+       Make a digest from the contents of the file
+    '''
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
 def local_to_utc(value):
     utc = datetime.datetime.utcfromtimestamp(time.mktime(value.timetuple()))
     return utc.replace(microsecond=value.microsecond)
@@ -505,35 +604,33 @@ def make_run_style_property(style_id):
 def make_paragraph(
         indent, right_indent, style, align, keep_lines, keep_next, list_info,
         properties=None):
-    style_tree = [['w:pPr']]
+    paragraph = make_element('w:p')
+    style_prop = make_element('w:pPr', parent=paragraph)
     if style is not None:
-        style_tree.append([['w:pStyle', {'w:val': style}]])
+        make_element('w:pStyle', {'w:val': style}, parent=style_prop)
     ind_attrs = {}
     if list_info is not None:
         num_id, list_level = list_info
-        style_tree.append([
-            ['w:numPr'],
-            [['w:ilvl', {'w:val': str(list_level)}]],
-            [['w:numId', {'w:val': str(num_id)}]],
-        ])
+        num_prop = make_element('w:numPr', parent=style_prop)
+        make_element('w:ilvl', {'w:val': str(list_level)}, parent=num_prop)
+        make_element('w:numId', {'w:val': str(num_id)}, parent=num_prop)
     if indent is not None:
         ind_attrs['w:leftChars'] = '0'
         ind_attrs['w:left'] = str(indent)
     if right_indent is not None:
         ind_attrs['w:right'] = str(right_indent)
     if ind_attrs:
-        style_tree.append([['w:ind', ind_attrs]])
+        make_element('w:ind', ind_attrs, parent=style_prop)
     if align is not None:
-        style_tree.append([['w:jc', {'w:val': align}]])
+        make_element('w:jc', {'w:val': align}, parent=style_prop)
     if keep_lines:
-        style_tree.append([['w:keepLines']])
+        make_element('w:keepLines', parent=style_prop)
     if keep_next:
-        style_tree.append([['w:keepNext']])
+        make_element('w:keepNext', parent=style_prop)
     if properties is not None:
-        style_tree.extend(properties)
-
-    paragraph_tree = [['w:p'], style_tree]
-    return make_element_tree(paragraph_tree)
+        for prop in properties:
+            style_prop.append(make_element_tree(prop))
+    return paragraph
 
 def make_paragraph_spacing_property(**kwargs):
     attr = {}
@@ -596,29 +693,46 @@ def make_section_prop_paragraph(section_prop):
     para[0].append(section_prop)
     return para
 
+_PRESERVE_SPACE = {'xml:space': 'preserve'}
+
 def make_run(text, style, preserve_space):
-    run_tree = [['w:r']]
-    run_prop = [['w:rPr']]
-    for tagname, attrib in style.items():
-        run_prop.append([[tagname, attrib]])
-    if len(run_prop) != 1:
-        run_tree.append(run_prop)
+    run = make_element('w:r')
+    if style:
+        run_prop = make_element('w:rPr', parent=run)
+        for tagname, attrib in style.items():
+            make_element(tagname, attrib, parent=run_prop)
     if preserve_space:
         lines = text.split('\n')
         for index, line in enumerate(lines):
-            run_tree.append([['w:t', line, {'xml:space': 'preserve'}]])
+            make_element('w:t', _PRESERVE_SPACE, line, parent=run)
             if index != len(lines) - 1:
-                run_tree.append([['w:br']])
+                make_element('w:br', parent=run)
     else:
         text = text.replace('\n', ' ')
-        attrs = {}
+        attrs = None
         if text.startswith(' ') or text.endswith(' '):
-            attrs['xml:space'] = 'preserve'
-        run_tree.append([['w:t', text, attrs]])
-    return make_element_tree(run_tree)
+            attrs = _PRESERVE_SPACE
+        make_element('w:t', attrs, text, parent=run)
+    return run
+
+def make_code_run(text, properties):
+    '''
+       Make a run of highlighted code. 'properties' is a sequence of
+       the tag names and the attributes of the run properties.
+    '''
+    run = make_element('w:r')
+    if properties:
+        run_prop = make_element('w:rPr', parent=run)
+        for tagname, attrib in properties:
+            make_element(tagname, attrib, parent=run_prop)
+    make_element(
+        'w:t', _PRESERVE_SPACE if ' ' in text else None, text, parent=run)
+    return run
+
+_BREAK_RUN = ElementPrototype([['w:r'], [['w:br']]])
 
 def make_break_run():
-    return make_element_tree([['w:r'], [['w:br']]])
+    return _BREAK_RUN.make()
 
 def make_inline_picture_run(
         rid, picid, picname, cmwidth, cmheight, picdescription,
@@ -629,15 +743,19 @@ def make_inline_picture_run(
 
       This function is based on 'python-docx' library
     '''
-    non_visual_pic_prop_attrs = {
-        'id': str(picid), 'name': picname, 'descr': picdescription
-    }
     # OpenXML measures on-screen objects in English Metric Units
     emupercm = 360000
-    ext_attrs = {
-        'cx': str(int(cmwidth * emupercm)),
-        'cy': str(int(cmheight * emupercm))
+    return _INLINE_PICTURE_RUN.make(
+        rid=rid, id=str(picid), name=picname, descr=picdescription,
+        cx=str(int(cmwidth * emupercm)), cy=str(int(cmheight * emupercm)),
+        noChangeAspect=str(int(nochangeaspect)),
+        noChangeArrowheads=str(int(nochangearrowheads)))
+
+def _make_inline_picture_run_prototype():
+    non_visual_pic_prop_attrs = {
+        'id': '{id}', 'name': '{name}', 'descr': '{descr}'
     }
+    ext_attrs = {'cx': '{cx}', 'cy': '{cy}'}
 
     # There are 3 main elements inside a picture
     pic_tree = [
@@ -646,15 +764,15 @@ def make_inline_picture_run(
          [['pic:cNvPr', non_visual_pic_prop_attrs]],
          [['pic:cNvPicPr'],
           [['a:picLocks', {
-              'noChangeAspect': str(int(nochangeaspect)),
-              'noChangeArrowheads': str(int(nochangearrowheads))}]
+              'noChangeAspect': '{noChangeAspect}',
+              'noChangeArrowheads': '{noChangeArrowheads}'}]
           ]
          ]
         ],
         # The Blipfill - specifies how the image fills the picture
         # area (stretch, tile, etc.)
         [['pic:blipFill'],
-         [['a:blip', {'r:embed': rid}]],
+         [['a:blip', {'r:embed': '{rid}'}]],
          [['a:srcRect']],
          [['a:stretch'], [['a:fillRect']]]
         ],
@@ -692,7 +810,9 @@ def make_inline_picture_run(
         [['w:rPr'], [['w:noProof']]],
         [['w:drawing'], inline_tree]
     ]
-    return make_element_tree(run_tree)
+    return ElementPrototype(run_tree)
+
+_INLINE_PICTURE_RUN = _make_inline_picture_run_prototype()
 
 def make_omath_paragraph(omath_elems):
     omath_paragraph = make_element_tree([
@@ -759,18 +879,18 @@ def make_row(index, is_head, cant_split, set_tbl_header, height):
         'w:oddHBand': ('true' if index % 2 == 0 else 'false'),
         'w:firstRow': ('true' if is_head else 'false'),
     }
-    property_tree = [
-        ['w:trPr'],
-        [['w:cnfStyle', row_style_attrs]],
-    ]
+    row = make_element('w:tr')
+    row_prop = make_element('w:trPr', parent=row)
+    make_element('w:cnfStyle', row_style_attrs, parent=row_prop)
     if cant_split:
-        property_tree.append([['w:cantSplit']])
+        make_element('w:cantSplit', parent=row_prop)
     if set_tbl_header:
-        property_tree.append([['w:tblHeader']])
+        make_element('w:tblHeader', parent=row_prop)
     if height is not None:
-        property_tree.append(
-            [['w:trHeight', {'w:hRule': 'atLeast', 'w:val': str(height)}]])
-    return make_element_tree([['w:tr'], property_tree])
+        make_element(
+            'w:trHeight', {'w:hRule': 'atLeast', 'w:val': str(height)},
+            parent=row_prop)
+    return row
 
 def make_cell(index, is_first_column, cellsize, grid_span, vmerge, rotation,
               no_wrap=None, valign=None):
@@ -779,24 +899,25 @@ def make_cell(index, is_first_column, cellsize, grid_span, vmerge, rotation,
         'w:oddVBand': ('true' if index % 2 == 0 else 'false'),
         'w:firstColumn': ('true' if is_first_column else 'false'),
     }
-    property_tree = [
-        ['w:tcPr'],
-        [['w:cnfStyle', cell_style]],
-    ]
+    cell = make_element('w:tc')
+    cell_prop = make_element('w:tcPr', parent=cell)
+    make_element('w:cnfStyle', cell_style, parent=cell_prop)
     if cellsize is not None:
-        property_tree.append(
-            [['w:tcW', {'w:w': '%f%%' % (cellsize * 100), 'w:type': 'pct'}]])
+        make_element(
+            'w:tcW', {'w:w': '%f%%' % (cellsize * 100), 'w:type': 'pct'},
+            parent=cell_prop)
     if grid_span > 1:
-        property_tree.append([['w:gridSpan', {'w:val': str(grid_span)}]])
+        make_element('w:gridSpan', {'w:val': str(grid_span)}, parent=cell_prop)
     if vmerge is not None:
-        property_tree.append([['w:vMerge', {'w:val': vmerge}]])
+        make_element('w:vMerge', {'w:val': vmerge}, parent=cell_prop)
     if rotation:
-        property_tree.append([['w:textDirection', {'w:val': 'tbRlV'}]])
+        make_element('w:textDirection', {'w:val': 'tbRlV'}, parent=cell_prop)
     if no_wrap is not None:
-        property_tree.append([['w:noWrap', {'w:val': str(int(no_wrap))}]])
+        make_element(
+            'w:noWrap', {'w:val': str(int(no_wrap))}, parent=cell_prop)
     if valign is not None:
-        property_tree.append([['w:vAlign', {'w:val': valign}]])
-    return make_element_tree([['w:tc'], property_tree])
+        make_element('w:vAlign', {'w:val': valign}, parent=cell_prop)
+    return cell
 
 def make_table_cell_margin_property(**kwargs):
     margin_tree = [['w:tblCellMar']]
@@ -975,7 +1096,7 @@ def create_rels_path(path):
 
 def get_relation_target(relationships, rel_type):
     return get_attribute(
-        relationships, 'pr:Relationship[@Type="%s"]' % rel_type, 'Target')
+        relationships, 'pr:Relationship[@Type=$type]', 'Target', type=rel_type)
 
 def get_relation_ids(relationships):
     if relationships is None:
@@ -1056,13 +1177,25 @@ class StyleInfo(object):
             self._style.remove(semihidden)
         self._semihidden_elems = []
 
+    def copy(self, elem_map):
+        '''
+           Return a copy whose elements are replaced according to elem_map
+        '''
+        # pylint: disable=protected-access
+        info = copy.copy(self)
+        info._style = elem_map[self._style]
+        info._semihidden_elems = [elem_map[e] for e in self._semihidden_elems]
+        return info
+
 
 class DocxDocument: # pylint: disable=too-many-public-methods
     def __init__(self, docxfile):
         '''
           Constructor
         '''
-        self.docx = zipfile.ZipFile(docxfile)
+        with zipfile.ZipFile(docxfile) as docx:
+            self._parts = dict(
+                (name, docx.read(name)) for name in docx.namelist())
         docpath = get_relation_target(
             self.get_xmltree('_rels/.rels'), REL_TYPE_DOC)
         if docpath.startswith('/'):
@@ -1074,6 +1207,42 @@ class DocxDocument: # pylint: disable=too-many-public-methods
         self.footnotes = self._get_rel_target_xml(REL_TYPE_FOOTNOTES)
         self.numbering = self._get_rel_target_xml(REL_TYPE_NUMBERING)
         self.styles = self._get_rel_target_xml(REL_TYPE_STYLES)
+        self._style_names = {} # style name => style element
+        self._style_ids = {} # style id => style element
+        for style in get_elements(self.styles, 'w:style'):
+            self._index_style(style)
+
+    def _index_style(self, style):
+        names = get_elements(style, 'w:name')
+        if names:
+            self._style_names.setdefault(names[0].get(norm_name('w:val')), style)
+        style_id = style.get(norm_name('w:styleId'))
+        if style_id is not None:
+            self._style_ids.setdefault(style_id, style)
+
+    def add_style(self, style):
+        '''
+          Append the style element to the styles, and index it
+        '''
+        self.styles.append(style)
+        self._index_style(style)
+
+    def copy(self, elem_map):
+        '''
+          Return a copy whose styles and numbering are copied,
+          and map the original elements to the copies
+        '''
+        # pylint: disable=protected-access
+        other = copy.copy(self)
+        other.styles = copy_element(self.styles, elem_map)
+        other.numbering = copy_element(self.numbering, elem_map)
+        other._style_names = dict(
+            (name, elem_map[style])
+            for name, style in self._style_names.items())
+        other._style_ids = dict(
+            (style_id, elem_map[style])
+            for style_id, style in self._style_ids.items())
+        return other
 
     def _get_rel_target_path(self, rel_type):
         target = get_relation_target(self.relationships, rel_type)
@@ -1145,7 +1314,7 @@ class DocxDocument: # pylint: disable=too-many-public-methods
           Extract a document tree from the docx file
         '''
         try:
-            return etree.fromstring(self.docx.read(fname))
+            return etree.fromstring(self._parts[fname])
         except KeyError:
             return None
 
@@ -1165,8 +1334,8 @@ class DocxDocument: # pylint: disable=too-many-public-methods
         '''
           Extract the last default style's id with style_type
         '''
-        xpath = 'w:style[@w:type="%s" and (@w:default="1" or @w:default="true")]'
-        styles = get_elements(self.styles, xpath % style_type)
+        xpath = 'w:style[@w:type=$type and (@w:default="1" or @w:default="true")]'
+        styles = get_elements(self.styles, xpath, type=style_type)
         if not styles:
             return None
         name = get_attribute(styles[-1], 'w:name', 'w:val')
@@ -1190,7 +1359,7 @@ class DocxDocument: # pylint: disable=too-many-public-methods
         return self._get_elements_until_target('./*[.//w:br[@w:type="page"]][1]')
     def get_image_numbers(self):
         img_nums = []
-        for path in self.docx.namelist():
+        for path in self._parts:
             match = re.match(r'word/media/image(\d+)\.\w+', path)
             if match is not None:
                 img_nums.append(int(match.group(1)))
@@ -1198,7 +1367,7 @@ class DocxDocument: # pylint: disable=too-many-public-methods
 
     def get_custom_xml_numbers(self):
         nums = []
-        for path in self.docx.namelist():
+        for path in self._parts:
             match = re.match(r'customXml/item(?:Props)?(\d+)\.xml', path)
             if match is not None:
                 nums.append(int(match.group(1)))
@@ -1207,7 +1376,7 @@ class DocxDocument: # pylint: disable=too-many-public-methods
     def collect_items(self, zip_docxfile, collected_files):
         # Add & compress support files
         for fname in collected_files:
-            zip_docxfile.writestr(fname, self.docx.read(fname))
+            zip_docxfile.writestr(fname, self._parts[fname])
 
     def collect_relation_files(self, rel_files, rel_attrs, basedir):
         for attr in rel_attrs:
@@ -1257,18 +1426,15 @@ class DocxDocument: # pylint: disable=too-many-public-methods
 ############
 # Numbering
     def get_numbering_style_id(self, style):
-        style_elems = get_elements(self.styles, '/w:styles/w:style')
-        for style_elem in style_elems:
-            name_elem = get_elements(style_elem, 'w:name')[0]
-            name = name_elem.attrib[norm_name('w:val')]
-            if name == style:
-                all_num_ids = get_elements(style_elem, 'w:pPr/w:numPr/w:numId')
-                if not all_num_ids:
-                    return None
-                num_pr = all_num_ids[-1]
-                value = num_pr.attrib[norm_name('w:val')]
-                return value
-        return None
+        style_elem = self._style_names.get(style)
+        if style_elem is None:
+            return None
+        all_num_ids = get_elements(style_elem, 'w:pPr/w:numPr/w:numId')
+        if not all_num_ids:
+            return None
+        num_pr = all_num_ids[-1]
+        value = num_pr.attrib[norm_name('w:val')]
+        return value
 
     def get_elems_from_numbering(self, elem_tag):
         if self.numbering is None:
@@ -1276,9 +1442,10 @@ class DocxDocument: # pylint: disable=too-many-public-methods
         return get_elements(self.numbering, elem_tag)
 
     def get_indent(self, style_id):
-        ind_elems = get_elements(
-            self.styles,
-            '/w:styles/w:style[@w:styleId="%s"]/w:pPr/w:ind' % style_id)
+        style_elem = self._style_ids.get(style_id)
+        if style_elem is None:
+            return None
+        ind_elems = get_elements(style_elem, 'w:pPr/w:ind')
         if not ind_elems:
             return None
         return get_left(ind_elems[0])
@@ -1320,16 +1487,288 @@ class IdElements(object):
     def __iter__(self):
         return iter(self._elems.items())
 
-def collect_used_rel_attrs(relationships, xml, used_rel_types):
+    def copy(self, elem_map):
+        '''
+           Return a copy whose elements are replaced according to elem_map
+        '''
+        # pylint: disable=protected-access
+        elems = copy.copy(self)
+        elems._elems = dict(
+            (key, elem_map[elem]) for key, elem in self._elems.items())
+        return elems
+
+def collect_used_rel_attrs(relationships, used_rel_types, used_rel_ids):
     if relationships is None:
         return []
     used_rel_attrs = []
     for rel in get_elements(relationships, 'pr:Relationship'):
         if (rel.get('Type') in used_rel_types
-                or get_elements(xml, '(.//*[@*="%s"])[1]' % rel.get('Id'))):
+                or rel.get('Id') in used_rel_ids):
             used_rel_attrs.append(rel.attrib)
     return used_rel_attrs
 
+class ReferenceCollector(object):
+    '''
+       Collector of the relationship ids and the num ids referenced from
+       element trees, which walks each tree only once
+    '''
+    num_id_tag = norm_name('w:numId')
+    val_attr = norm_name('w:val')
+
+    def __init__(self, relationships):
+        self._rel_ids = set()
+        if relationships is not None:
+            self._rel_ids.update(
+                rel.get('Id')
+                for rel in get_elements(relationships, 'pr:Relationship'))
+        self.used_rel_ids = set()
+        self.used_num_ids = set()
+
+    def collect(self, xml):
+        num_id_tag = type(self).num_id_tag
+        val_attr = type(self).val_attr
+        for elem in xml.iter(tag=etree.Element):
+            if elem.tag == num_id_tag:
+                self.used_num_ids.add(int(elem.get(val_attr)))
+            for value in elem.attrib.values():
+                if value in self._rel_ids:
+                    self.used_rel_ids.add(value)
+
+# os.replace is not available in Python 2
+replace_file = getattr(os, 'replace', os.rename)
+
+# Extensions of images whose content types are known
+IMAGE_EXTENSIONS = frozenset([
+    'bmp', 'emf', 'gif', 'ico', 'jpeg', 'jpg', 'png', 'tif', 'tiff', 'webp',
+])
+
+# Extensions for the image formats detected by PIL
+IMAGE_FORMAT_EXTENSIONS = {
+    'BMP': '.bmp', 'GIF': '.gif', 'ICO': '.ico', 'JPEG': '.jpeg',
+    'PNG': '.png', 'TIFF': '.tiff', 'WEBP': '.webp',
+}
+
+# Extensions of media whose data is already compressed
+COMPRESSED_MEDIA_EXTENSIONS = frozenset([
+    '.gif', '.jpeg', '.jpg', '.png', '.webp',
+])
+
+class PrecompressedData(object):
+    '''
+       Compressor which returns the data deflated in advance
+    '''
+    def __init__(self, compressed):
+        self._compressed = compressed
+
+    def compress(self, _data):
+        compressed, self._compressed = self._compressed, b''
+        return compressed
+
+    def flush(self): # pylint: disable=no-self-use
+        return b''
+
+def deflate(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+_precompression_available = None # pylint: disable=invalid-name
+
+def is_precompression_available():
+    '''
+       Return true if the data deflated in advance can be written to
+       zip files, which depends on the internals of zipfile
+    '''
+    global _precompression_available # pylint: disable=global-statement,invalid-name
+    if _precompression_available is None:
+        try:
+            with zipfile.ZipFile(io.BytesIO(), 'w') as zip_file:
+                with zip_file.open('probe', 'w') as entry:
+                    _precompression_available = hasattr(entry, '_compressor')
+        except Exception: # pylint: disable=broad-except
+            _precompression_available = False
+    return _precompression_available
+
+class PackageWriter(object):
+    '''
+       Writer of the parts of a docx package, which compresses each part
+       according to the compression options.
+
+       The supported options are:
+
+       level
+          Compression level of parts other than media (default: -1)
+       media_level
+          Compression level of media (default: level)
+       store_compressed_media
+          If true, media already compressed, such as PNG, are stored
+          without compression (default: True)
+       threads
+          The number of threads which deflate large parts in parallel.
+          If this is 0, or is_precompression_available returns false,
+          parts are deflated sequentially (default: 0)
+       thread_min_size
+          The minimum size of parts deflated by the threads (default: 1MiB)
+    '''
+    def __init__(self, zip_file, options):
+        self._zip_file = zip_file
+        self._level = options.get('level', -1)
+        self._media_level = options.get('media_level', self._level)
+        self._store_compressed_media = options.get(
+            'store_compressed_media', True)
+        self._thread_min_size = options.get('thread_min_size', 1024 * 1024)
+        threads = options.get('threads', 0)
+        if threads > 0 and is_precompression_available():
+            self._pool = ThreadPool(threads)
+        else:
+            self._pool = None
+        self._entries = [] # (ZipInfo, data, deflated data or None)
+
+    def writestr(self, name, data):
+        info = self._make_info(name)
+        if (self._pool is not None
+                and info.compress_type == zipfile.ZIP_DEFLATED
+                and len(data) >= self._thread_min_size):
+            deflated = self._pool.apply_async(
+                deflate, (data, self._get_level(name)))
+            self._entries.append((info, data, deflated))
+        else:
+            self._entries.append((info, data, None))
+
+    def write(self, filename, name):
+        if self._pool is not None:
+            with open(filename, 'rb') as f:
+                self.writestr(name, f.read())
+            return
+        self._write_entries()
+        info = self._make_info(name)
+        if sys.version_info >= (3, 7):
+            self._zip_file.write(
+                filename, name, info.compress_type, self._get_level(name))
+        else:
+            self._zip_file.write(filename, name, info.compress_type)
+
+    def write_fileobj(self, name, fileobj):
+        '''
+           Write the contents of the file object without reading the whole
+           contents into memory, if possible
+        '''
+        if sys.version_info < (3, 6):
+            self.writestr(name, fileobj.read())
+            return
+        info = self._make_info(name)
+        level = self._get_level(name)
+        if hasattr(info, 'compress_level'): # Python 3.13 or later
+            info.compress_level = level
+        elif level != zlib.Z_DEFAULT_COMPRESSION:
+            # The level of entries opened for writing can not be specified
+            self.writestr(name, fileobj.read())
+            return
+        self._write_entries()
+        size = os.fstat(fileobj.fileno()).st_size
+        with self._zip_file.open(
+                info, 'w', force_zip64=size > zipfile.ZIP64_LIMIT) as entry:
+            shutil.copyfileobj(fileobj, entry)
+
+    def close(self):
+        try:
+            self._write_entries()
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+
+    def _write_entries(self):
+        for info, data, deflated in self._entries:
+            if deflated is None:
+                if sys.version_info >= (3, 7):
+                    self._zip_file.writestr(
+                        info, data,
+                        compresslevel=self._get_level(info.filename))
+                else:
+                    self._zip_file.writestr(info, data)
+                continue
+            with self._zip_file.open(info, 'w') as entry:
+                # Replace the compressor with the data deflated by the thread,
+                # which is checked by is_precompression_available
+                entry._compressor = PrecompressedData(deflated.get()) # pylint: disable=protected-access
+                entry.write(data)
+        self._entries = []
+
+    def _make_info(self, name):
+        info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        if self._store_compressed_media and self._is_compressed_media(name):
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o600 << 16
+        return info
+
+    def _get_level(self, name):
+        if name.startswith('word/media/'):
+            return self._media_level
+        return self._level
+
+    @staticmethod
+    def _is_compressed_media(name):
+        _, ext = posixpath.splitext(name)
+        return (name.startswith('word/media/')
+                and ext.lower() in COMPRESSED_MEDIA_EXTENSIONS)
+
+class BodyStream(object):
+    '''
+       Writer which serializes body elements to a temporary file,
+       and collects the ids referenced from the written elements
+    '''
+    MARKER = 'docxbuilder-body-contents'
+
+    def __init__(self, document, relationships):
+        self.references = ReferenceCollector(relationships)
+        # The document without the body contents is split at the marker
+        root = etree.Element(
+            document.tag, attrib=document.attrib, nsmap=document.nsmap)
+        for child in document:
+            if child.tag == norm_name('w:body'):
+                body = etree.SubElement(root, child.tag, attrib=child.attrib)
+                body.text = BodyStream.MARKER
+            else:
+                root.append(copy.deepcopy(child))
+        head, self._tail = etree.tostring(
+            root, xml_declaration=True, encoding='UTF-8', standalone=True
+        ).split(BodyStream.MARKER.encode('ascii'))
+        # Namespace declarations which are in scope in the body
+        self._declarations = re.compile(b' xmlns:(%s)="([^"]*)"' % b'|'.join(
+            re.escape(prefix.encode('ascii'))
+            for prefix in document.nsmap if prefix))
+        self._nsmap = dict(
+            (prefix.encode('ascii'), uri.encode('utf-8'))
+            for prefix, uri in document.nsmap.items() if prefix)
+        self._file = tempfile.TemporaryFile()
+        self._file.write(head)
+
+    def write(self, elem):
+        self.references.collect(elem)
+        xml = etree.tostring(elem, encoding='UTF-8')
+        # The declarations on the start tag of the element are removed if
+        # they are the same as those of the document element
+        end = xml.index(b'>')
+        start_tag = self._declarations.sub(self._remove_declaration, xml[:end])
+        self._file.write(start_tag)
+        self._file.write(xml[end:])
+
+    def _remove_declaration(self, match):
+        if self._nsmap.get(match.group(1)) == match.group(2):
+            return b''
+        return match.group(0)
+
+    def close(self):
+        '''
+           Finish the document, and return the file object
+           which contains the serialized document
+        '''
+        self._file.write(self._tail)
+        self._file.seek(0)
+        return self._file
+
 class CoverPagePropertyInfo(object):
     def __init__(self, does_create, info):
         self.does_create = does_create
@@ -1384,20 +1823,76 @@ def collect_referenced_footnotes(footnotes, xml):
             footnote_id_map[int(fid)] = fid
     return footnote_map, footnote_id_map, footnote_id_pool
 
+class Fragment(object):
+    '''
+       Serialized elements with the operations which allocated ids and
+       resources referenced from the elements
+    '''
+    def __init__(self, body, journal):
+        self.body = body
+        self.journal = journal
+
+    def get_image_paths(self):
+        return set(entry[2] for entry in self.journal if entry[0] == 'image')
+
+FRAGMENT_ID_ATTRS = {
+    norm_name('w:bookmarkStart'): (norm_name('w:id'), 'bookmark'),
+    norm_name('w:bookmarkEnd'): (norm_name('w:id'), 'bookmark'),
+    norm_name('wp:docPr'): ('id', 'id'),
+    norm_name('pic:cNvPr'): ('id', 'id'),
+    norm_name('w:footnoteReference'): (norm_name('w:id'), 'fid'),
+    norm_name('w:numId'): (norm_name('w:val'), 'num'),
+}
+
+def renumber_fragment_ids(xml, id_map, part):
+    '''
+       Replace ids in the fragment element according to id_map
+    '''
+    rel_ns = '{%s}' % NSPREFIXES['r']
+    for elem in xml.iter(tag=etree.Element):
+        id_attr = FRAGMENT_ID_ATTRS.get(elem.tag)
+        if id_attr is not None:
+            attr, kind = id_attr
+            value = id_map.get((kind, elem.get(attr)))
+            if value is not None:
+                elem.set(attr, value)
+        for attr, value in elem.attrib.items():
+            if attr.startswith(rel_ns):
+                elem.set(attr, id_map.get(('rid', part, value), value))
+    return xml
+
+_NULL_TRACE_SPAN = NullSpan()
+
+def null_trace_span(_step):
+    '''
+       Return a context which does not trace anything
+    '''
+    return _NULL_TRACE_SPAN
+
 #
 # DocxComposer Class
 #
 
 
 class DocxComposer: # pylint: disable=too-many-public-methods
-    def __init__(self, stylefile, has_coverpage):
+    def __init__(self, stylefile, has_coverpage, image_info_cache=None,
+                 trace_span=None):
         '''
            Constructor
+
+           image_info_cache is an object whose get method returns the metadata,
+           such as the format, of the image file.
+           trace_span is a function which takes a step name and returns
+           a context to trace the step, such as docxbuilder.trace.span.
         '''
         self._id = 100
+        self._image_info_cache = image_info_cache
         self.style_docx = DocxDocument(stylefile)
 
         self._style_info = self.style_docx.extract_style_info()
+        self._style_info_ids = {} # style id => style info
+        for info in self._style_info.values():
+            self._style_info_ids.setdefault(info.style_id, info)
         self._abstract_nums = IdElements(
             self.style_docx.get_elems_from_numbering('w:abstractNum'),
             norm_name('w:abstractNumId'))
@@ -1416,6 +1911,9 @@ class DocxComposer: # pylint: disable=too-many-public-methods
         self._add_required_relationships(self._cover_page_prop_info)
         self._hyperlink_rid_map = {} # target => relationship id
         self._image_info_map = {} # imagepath => (relationship id, imagename)
+        self._image_path_map = {} # imagepath => imagepath of the same contents
+        self._image_digest_map = {} # digest of contents => imagepath
+        self._image_size_map = {} # imagepath => maximum size displayed in cm
         self._img_num_pool = IdPool(self.style_docx.get_image_numbers())
 
         self.document = make_element_tree([['w:document'], [['w:body']]])
@@ -1423,14 +1921,85 @@ class DocxComposer: # pylint: disable=too-many-public-methods
         if has_coverpage:
             self.docbody.extend(self.get_coverpage_elements())
 
+        self._bookmark_id = self.get_max_bookmark_id()
+
         footnote_info = collect_referenced_footnotes(
             self.style_docx.footnotes, self.docbody)
         self._footnote_map = footnote_info[0] # docname#id => footnote contents
         self._footnote_id_map = footnote_info[1] # footnote_id => docname#id
         self._footnote_id_pool = footnote_info[2]
 
+        self._section_properties = None
+        self._body_stream = None
         self._run_style_property_cache = {}
         self._table_margin_cache = {}
+        self._recorders = []
+        self._trace = trace_span or null_trace_span
+
+    def clone(self):
+        '''
+           Return a copy of this composer, which shares the immutable parts,
+           such as parsed XML trees only read, with this composer
+        '''
+        # pylint: disable=protected-access
+        other = copy.copy(self)
+        elem_map = {}
+        other.style_docx = self.style_docx.copy(elem_map)
+        other._style_info = dict(
+            (name, info.copy(elem_map))
+            for name, info in self._style_info.items())
+        other._style_info_ids = {}
+        for info in other._style_info.values():
+            other._style_info_ids.setdefault(info.style_id, info)
+        other._abstract_nums = self._abstract_nums.copy(elem_map)
+        other._nums = self._nums.copy(elem_map)
+
+        other._relationships_map = dict(
+            (part, (list(relationships), copy.copy(id_pool)))
+            for part, (relationships, id_pool)
+            in self._relationships_map.items())
+        other._hyperlink_rid_map = dict(
+            (target, dict(rid_map))
+            for target, rid_map in self._hyperlink_rid_map.items())
+        other._image_info_map = dict(
+            (imagepath, (dict(rid_map), picname))
+            for imagepath, (rid_map, picname) in self._image_info_map.items())
+        other._image_path_map = dict(self._image_path_map)
+        other._image_digest_map = dict(self._image_digest_map)
+        other._image_size_map = dict(self._image_size_map)
+        other._img_num_pool = copy.copy(self._img_num_pool)
+
+        other.document = copy.deepcopy(self.document)
+        other.docbody = get_elements(other.document, '/w:document/w:body')[0]
+
+        other._footnote_map = dict(self._footnote_map)
+        other._footnote_id_map = dict(self._footnote_id_map)
+        other._footnote_id_pool = copy.copy(self._footnote_id_pool)
+
+        other._run_style_property_cache = dict(self._run_style_property_cache)
+        other._table_margin_cache = dict(self._table_margin_cache)
+        other._recorders = []
+        other._body_stream = None
+        return other
+
+    def start_body_stream(self):
+        '''
+           Start writing the body elements flushed by flush_body
+           to a temporary file instead of holding them in the document tree
+        '''
+        self._body_stream = BodyStream(
+            self.document, self.style_docx.relationships)
+
+    def flush_body(self, count):
+        '''
+           Write the first count elements of the body to the stream,
+           if streaming is enabled
+        '''
+        if self._body_stream is None:
+            return
+        for elem in self.docbody[:count]:
+            self._body_stream.write(elem)
+            self.docbody.remove(elem)
 
     def get_coverpage_elements(self):
         coverpage = self.style_docx.get_coverpage()
@@ -1446,9 +2015,20 @@ class DocxComposer: # pylint: disable=too-many-public-methods
 
     def new_id(self):
         self._id += 1
+        self._record('id', self._id)
         return self._id
 
+    def new_bookmark_id(self):
+        self._bookmark_id += 1
+        self._record('bookmark_id', self._bookmark_id)
+        return self._bookmark_id
+
     def get_section_properties(self):
+        if self._section_properties is None:
+            self._section_properties = self._make_section_properties()
+        return self._section_properties
+
+    def _make_section_properties(self):
         result = {'portrait': [], 'landscape': []}
         section_props = self.style_docx.get_section_properties()
         if not section_props:
@@ -1481,10 +2061,7 @@ class DocxComposer: # pylint: disable=too-many-public-methods
         return None
 
     def get_style_info_from_id(self, style_id):
-        for style_info in self._style_info.values():
-            if style_info.style_id == style_id:
-                return style_info
-        return None
+        return self._style_info_ids.get(style_id)
 
     def get_style_id(self, style_name, style_type):
         if style_name is None:
@@ -1495,6 +2072,7 @@ class DocxComposer: # pylint: disable=too-many-public-methods
         if style_info.style_type != style_type:
             return None
         style_info.used()
+        self._record('get_style_id', (style_name, style_type))
         return style_info.style_id
 
     def get_indent(self, style_name, default):
@@ -1561,9 +2139,42 @@ class DocxComposer: # pylint: disable=too-many-public-methods
             right = right or based_right
         return self._table_margin_cache.setdefault(style_id, (left, right))
 
-    def asbytes(self, set_update_fields, props):
+    def asbytes(self, set_update_fields, props, image_files=None):
         '''Generate the composed document as docx binary.
         '''
+        bytes_io = io.BytesIO()
+        self.write_package(
+            bytes_io, set_update_fields, props, image_files=image_files)
+        return bytes_io.getvalue()
+
+    def save(self, filename, set_update_fields, props, compression=None,
+             image_files=None):
+        '''Write the composed document to the file.
+
+           The document is written to a temporary file in the same directory
+           at first, and then the file is renamed, so that the existing file
+           is not broken even if writing fails.
+        '''
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        try:
+            with open(tmpname, 'wb') as f:
+                self.write_package(
+                    f, set_update_fields, props, compression, image_files)
+            with self._trace('replace_file'):
+                replace_file(tmpname, filename)
+        finally:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    def write_package(
+            self, fileobj, set_update_fields, props, compression=None,
+            image_files=None):
+        '''Write the composed document as docx package to the file object.
+
+           compression is a dictionary of the options of PackageWriter.
+           image_files is a dictionary from the paths of images to the files
+           embedded instead of them, such as downscaled images.
+        '''
         xml_files = [
             ('_rels/.rels', self.make_root_rels()),
             ('docProps/app.xml', self.make_app(props['app'])),
@@ -1571,33 +2182,30 @@ class DocxComposer: # pylint: disable=too-many-public-methods
             ('docProps/custom.xml', self.make_custom(props['custom'])),
         ]
 
-        inherited_rel_attrs = self.collect_inherited_rel_attrs()
-        footnotes = self.make_footnotes()
-        numbering = self.make_numbering(inherited_rel_attrs, footnotes)
-
-        document_rels = self.make_document_rels(inherited_rel_attrs)
-        xml_files.append(('word/_rels/document.xml.rels', document_rels))
-        footnotes_rel_attrs = collect_used_rel_attrs(
-            self.style_docx.footnotes_relationships, footnotes, set())
-        footnotes_rels = self.make_footnotes_rels(footnotes_rel_attrs)
-        if footnotes_rels is not None:
-            xml_files.append(('word/_rels/footnotes.xml.rels', footnotes_rels))
-        numbering_rel_attrs = collect_used_rel_attrs(
-            self.style_docx.numbering_relationships, numbering, set())
-        if numbering_rel_attrs:
-            numbering_rels = self.make_numbering_rels(numbering_rel_attrs)
-            xml_files.append(('word/_rels/numbering.xml.rels', numbering_rels))
+        (inherited_rel_attrs, footnotes, document_refs,
+         footnotes_refs) = self._collect_references()
+        with self._trace('make_numbering'):
+            numbering = self.make_numbering(
+                inherited_rel_attrs,
+                document_refs.used_num_ids | footnotes_refs.used_num_ids)
+
+        with self._trace('make_relationships'):
+            rels_parts, part_rel_attrs = self._build_relationship_parts(
+                inherited_rel_attrs, footnotes_refs, numbering)
+        xml_files.extend(rels_parts)
         settings = self.make_settings(set_update_fields)
 
-        xml_files.append(('word/document.xml', self.document))
+        if self._body_stream is None:
+            xml_files.append(('word/document.xml', self.document))
         xml_files.append(('word/footnotes.xml', footnotes))
         xml_files.append(('word/numbering.xml', numbering))
         xml_files.append(('word/styles.xml', self.style_docx.styles))
         xml_files.append(('word/settings.xml', settings))
 
-        inherited_files = self.style_docx.collect_all_relation_files(
-            inherited_rel_attrs + footnotes_rel_attrs + numbering_rel_attrs)
-        content_types = self.make_content_types(inherited_files)
+        with self._trace('make_content_types'):
+            inherited_files = self.style_docx.collect_all_relation_files(
+                inherited_rel_attrs + part_rel_attrs)
+            content_types = self.make_content_types(inherited_files)
         xml_files.append(('[Content_Types].xml', content_types))
 
         if self._cover_page_prop_info.does_create:
@@ -1609,19 +2217,89 @@ class DocxComposer: # pylint: disable=too-many-public-methods
                 (self._cover_page_prop_info.path, cover_page_props))
             inherited_files.remove(self._cover_page_prop_info.path)
 
-        bytes_io = io.BytesIO()
-        with zipfile.ZipFile(
-                bytes_io, mode='w', compression=zipfile.ZIP_DEFLATED) as out:
-            self.style_docx.collect_items(out, inherited_files)
-            for xmlpath, xml in xml_files:
-                treestring = etree.tostring(
-                    xml, xml_declaration=True,
-                    encoding='UTF-8', standalone='yes')
-                out.writestr(xmlpath, treestring)
-            for imgpath, (_, picname) in self._image_info_map.items():
-                out.write(imgpath, 'word/media/' + picname)
+        self._write_parts(
+            fileobj, xml_files, inherited_files, compression, image_files)
 
-        return bytes_io.getvalue()
+    def _collect_references(self):
+        '''Collect the references in the document and the footnotes.
+
+           Return the relationship attributes inherited from the style file
+           by the document, the footnotes, and the reference collectors of
+           the document and the footnotes.
+        '''
+        with self._trace('collect_references'):
+            if self._body_stream is not None:
+                self.flush_body(len(self.docbody))
+                document_refs = self._body_stream.references
+            else:
+                document_refs = ReferenceCollector(
+                    self.style_docx.relationships)
+            document_refs.collect(self.document)
+            inherited_rel_attrs = self.collect_inherited_rel_attrs(
+                document_refs.used_rel_ids)
+            footnotes = self.make_footnotes()
+            footnotes_refs = ReferenceCollector(
+                self.style_docx.footnotes_relationships)
+            footnotes_refs.collect(footnotes)
+        return inherited_rel_attrs, footnotes, document_refs, footnotes_refs
+
+    def _build_relationship_parts(
+            self, inherited_rel_attrs, footnotes_refs, numbering):
+        '''Return the relationship parts of the document, the footnotes and
+           the numbering, and the relationship attributes inherited from
+           the style file by the footnotes and the numbering.
+        '''
+        parts = [(
+            'word/_rels/document.xml.rels',
+            self.make_document_rels(inherited_rel_attrs))]
+        footnotes_rel_attrs = collect_used_rel_attrs(
+            self.style_docx.footnotes_relationships, set(),
+            footnotes_refs.used_rel_ids)
+        footnotes_rels = self.make_footnotes_rels(footnotes_rel_attrs)
+        if footnotes_rels is not None:
+            parts.append(('word/_rels/footnotes.xml.rels', footnotes_rels))
+        numbering_refs = ReferenceCollector(
+            self.style_docx.numbering_relationships)
+        numbering_refs.collect(numbering)
+        numbering_rel_attrs = collect_used_rel_attrs(
+            self.style_docx.numbering_relationships, set(),
+            numbering_refs.used_rel_ids)
+        if numbering_rel_attrs:
+            numbering_rels = self.make_numbering_rels(numbering_rel_attrs)
+            parts.append(('word/_rels/numbering.xml.rels', numbering_rels))
+        return parts, footnotes_rel_attrs + numbering_rel_attrs
+
+    def _write_parts(
+            self, fileobj, xml_files, inherited_files, compression,
+            image_files):
+        '''Write the parts inherited from the style file, the xml parts and
+           the images to the package.
+        '''
+        with zipfile.ZipFile(
+                fileobj, mode='w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+            out = PackageWriter(zip_file, compression or {})
+            try:
+                with self._trace('write_inherited_parts'):
+                    self.style_docx.collect_items(out, inherited_files)
+                with self._trace('write_xml_parts'):
+                    for xmlpath, xml in xml_files:
+                        treestring = etree.tostring(
+                            xml, xml_declaration=True,
+                            encoding='UTF-8', standalone='yes')
+                        out.writestr(xmlpath, treestring)
+                    if self._body_stream is not None:
+                        with self._body_stream.close() as document:
+                            out.write_fileobj('word/document.xml', document)
+                        self._body_stream = None
+                with self._trace('write_media'):
+                    image_files = image_files or {}
+                    for imgpath, (_, picname) in self._image_info_map.items():
+                        out.write(
+                            image_files.get(imgpath, imgpath),
+                            'word/media/' + picname)
+            finally:
+                with self._trace('close_package'):
+                    out.close()
 
 
  ##################
@@ -1676,13 +2354,13 @@ class DocxComposer: # pylint: disable=too-many-public-methods
            Create a new numbering definition
         '''
         abstract_num_id = self._abstract_nums.next_id()
-        typ = self.__class__.num_format_map.get(typ, 'decimal')
+        num_typ = self.__class__.num_format_map.get(typ, 'decimal')
         lvl_tree = [
             ['w:lvl', {'w:ilvl': '0'}],
             [['w:start', {'w:val': str(start_val)}]],
             [['w:lvlText', {'w:val': lvl_txt}]],
             [['w:lvlJc', {'w:val': 'left'}]],
-            [['w:numFmt', {'w:val': typ}]],
+            [['w:numFmt', {'w:val': num_typ}]],
             [['w:pPr'], [['w:ind', {
                 'w:left': str(indent), 'w:hanging': str(int(indent * 0.75))
             }]]],
@@ -1707,6 +2385,8 @@ class DocxComposer: # pylint: disable=too-many-public-methods
         ]
         num = make_element_tree(num_tree)
         self._nums.append(num)
+        self._record('numbering', num_id, (
+            start_val, lvl_txt, typ, indent, style_id, font))
         return num_id
 
     def get_default_style_names(self):
@@ -1725,6 +2405,8 @@ class DocxComposer: # pylint: disable=too-many-public-methods
            Create a new style_stype style with new_style_id,
            which is based on based_style_id.
         '''
+        self._record('create_style', (
+            style_type, new_style_name, based_style_name, is_custom, is_hidden))
         return self._create_style(
             style_type, new_style_name, is_custom, is_hidden,
             based_style_name=based_style_name)
@@ -1800,8 +2482,10 @@ class DocxComposer: # pylint: disable=too-many-public-methods
         if make_property_tree is not None:
             style_tree.append(make_property_tree(new_style_id))
         new_style = make_element_tree(style_tree)
-        self.style_docx.styles.append(new_style)
-        self._style_info[new_style_name] = StyleInfo(new_style)
+        self.style_docx.add_style(new_style)
+        style_info = StyleInfo(new_style)
+        self._style_info[new_style_name] = style_info
+        self._style_info_ids.setdefault(new_style_id, style_info)
         return True
 
     def _add_required_relationships(self, cover_page_prop_info):
@@ -1825,6 +2509,11 @@ class DocxComposer: # pylint: disable=too-many-public-methods
             })
 
     def add_hyperlink_relationship(self, target, part):
+        rid = self._add_hyperlink_relationship(target, part)
+        self._record('hyperlink', rid, target, part)
+        return rid
+
+    def _add_hyperlink_relationship(self, target, part):
         rid_map = self._hyperlink_rid_map.get(target)
         if rid_map is not None:
             rid = rid_map.get(part, None)
@@ -1845,18 +2534,31 @@ class DocxComposer: # pylint: disable=too-many-public-methods
         self._hyperlink_rid_map[target] = rid_map
         return rid
 
-    def add_image_relationship(self, imagepath, part):
+    def add_image_relationship(self, imagepath, part, cm_size=None):
+        '''
+           Add the relationship to the image, and return its id.
+           cm_size is a pair of the width and height with which the image
+           is displayed.
+        '''
         imagepath = os.path.abspath(imagepath)
+        rid = self._add_image_relationship(imagepath, part, cm_size)
+        self._record('image', rid, imagepath, part, cm_size)
+        return rid
 
+    def _add_image_relationship(self, imagepath, part, cm_size):
+        # Images with the same contents share a media part
+        imagepath = self._get_unique_image_path(imagepath)
+        if cm_size is not None:
+            width, height = self._image_size_map.get(imagepath, (0, 0))
+            self._image_size_map[imagepath] = (
+                max(width, cm_size[0]), max(height, cm_size[1]))
         rid_map, picname = self._image_info_map.get(imagepath, (None, None))
         if rid_map is not None:
             rid = rid_map.get(part, None)
             if rid is not None:
                 return rid
         else:
-            _, picext = os.path.splitext(imagepath)
-            if picext == '.jpg':
-                picext = '.jpeg'
+            picext = self._get_image_extension(imagepath)
             rid_map = {}
             picname = 'image%d%s' % (self._img_num_pool.next_id(), picext)
 
@@ -1871,18 +2573,123 @@ class DocxComposer: # pylint: disable=too-many-public-methods
         self._image_info_map[imagepath] = (rid_map, picname)
         return rid
 
+    def get_image_display_sizes(self):
+        '''
+           Return a dictionary from the paths of the embedded images to
+           the maximum width and height in cm with which they are displayed
+        '''
+        return dict(self._image_size_map)
+
+    def _get_unique_image_path(self, imagepath):
+        unique_path = self._image_path_map.get(imagepath)
+        if unique_path is None:
+            if self._image_info_cache is not None:
+                digest = self._image_info_cache.get_digest(imagepath)
+            else:
+                digest = get_file_digest(imagepath)
+            unique_path = self._image_digest_map.setdefault(digest, imagepath)
+            self._image_path_map[imagepath] = unique_path
+        return unique_path
+
+    def _get_image_extension(self, imagepath):
+        _, picext = os.path.splitext(imagepath)
+        if picext == '.jpg':
+            picext = '.jpeg'
+        if picext[1:].lower() in IMAGE_EXTENSIONS:
+            return picext
+        # Use the detected format for files without known extensions
+        if self._image_info_cache is not None:
+            try:
+                image_format = self._image_info_cache.get(imagepath).format
+            except Exception: # pylint: disable=broad-except
+                return picext
+            return IMAGE_FORMAT_EXTENSIONS.get(image_format, picext)
+        return picext
+
     def get_footnote_id(self, key):
         fid = self._footnote_id_pool.next_id()
         self._footnote_id_map[fid] = key
+        self._record('footnote_id', fid, key)
         return fid
 
     def append_footnote(self, key, contents):
         footnote = make_element_tree([['w:footnote']])
         footnote.extend(contents)
         self._footnote_map[key] = footnote
+        self._record('footnote', key, footnote)
+
+    def begin_fragment(self):
+        '''
+           Start recording operations, which affect the package, in order to
+           make a fragment reusable in other documents
+        '''
+        self._recorders.append([])
+
+    def end_fragment(self, elements):
+        '''
+           Stop the last recording, and return a fragment which consists of
+           the elements and the recorded operations
+        '''
+        journal = []
+        for entry in self._recorders.pop():
+            if entry[0] == 'footnote':
+                entry = ('footnote', entry[1], etree.tostring(entry[2]))
+            journal.append(entry)
+        return Fragment([
+            elem if isinstance(elem, bytes) else etree.tostring(elem)
+            for elem in elements
+        ], journal)
+
+    def insert_fragment(self, fragment):
+        '''
+           Replay the operations recorded in the fragment, and return
+           the fragment elements whose ids are renumbered for this document
+        '''
+        id_map = {}
+        footnotes = []
+        for entry in fragment.journal:
+            kind = entry[0]
+            if kind == 'id':
+                id_map[('id', str(entry[1]))] = str(self.new_id())
+            elif kind == 'bookmark_id':
+                id_map[('bookmark', str(entry[1]))] = str(self.new_bookmark_id())
+            elif kind == 'get_style_id':
+                self.get_style_id(*entry[1])
+            elif kind == 'create_style':
+                self.create_style(*entry[1])
+            elif kind == 'numbering':
+                id_map[('num', str(entry[1]))] = str(
+                    self.add_numbering_style(*entry[2]))
+            elif kind == 'image':
+                _, rid, imagepath, part, cm_size = entry
+                id_map[('rid', part, rid)] = self.add_image_relationship(
+                    imagepath, part, cm_size)
+            elif kind == 'hyperlink':
+                _, rid, target, part = entry
+                id_map[('rid', part, rid)] = self.add_hyperlink_relationship(
+                    target, part)
+            elif kind == 'footnote_id':
+                id_map[('fid', str(entry[1]))] = str(
+                    self.get_footnote_id(entry[2]))
+            elif kind == 'footnote':
+                footnotes.append((entry[1], entry[2]))
+        for key, footnote in footnotes:
+            footnote = renumber_fragment_ids(
+                etree.fromstring(footnote), id_map, 'footnotes')
+            self.append_footnote(key, list(footnote))
+        return [
+            renumber_fragment_ids(etree.fromstring(elem), id_map, 'document')
+            for elem in fragment.body
+        ]
+
+    def _record(self, *entry):
+        for recorder in self._recorders:
+            recorder.append(entry)
 
-    def collect_inherited_rel_attrs(self):
+    def collect_inherited_rel_attrs(self, used_rel_ids):
         """Collect relationships inherited from style file.
+
+        used_rel_ids is a set of the relationship ids referenced from the body
         """
         implicit_rel_types = {
             REL_TYPE_COMMENTS,
@@ -1897,7 +2704,7 @@ class DocxComposer: # pylint: disable=too-many-public-methods
             REL_TYPE_THUMBNAIL,
         }
         return collect_used_rel_attrs(
-            self.style_docx.relationships, self.document, implicit_rel_types)
+            self.style_docx.relationships, implicit_rel_types, used_rel_ids)
 
     def make_content_types(self, inherited_files):
         '''create [Content_Types].xml
@@ -2077,17 +2884,18 @@ class DocxComposer: # pylint: disable=too-many-public-methods
             footnotes.append(footnote)
         return footnotes
 
-    def make_numbering(self, inherited_rel_attrs, footnotes):
+    def make_numbering(self, inherited_rel_attrs, used_num_ids):
         """Create numbering.xml from nums and abstract nums in use
+
+        used_num_ids is a set of the num ids referenced from the body
+        and footnotes
         """
-        used_num_ids = self.style_docx.collect_num_ids(inherited_rel_attrs)
+        used_num_ids = used_num_ids | self.style_docx.collect_num_ids(
+            inherited_rel_attrs)
         val_attr = norm_name('w:val')
-        def update_used_num_ids(xml):
-            elems = get_elements(xml, '//w:numId')
-            used_num_ids.update((int(num_id.get(val_attr)) for num_id in elems))
-        update_used_num_ids(self.style_docx.styles)
-        update_used_num_ids(self.document)
-        update_used_num_ids(footnotes)
+        used_num_ids.update(
+            int(num_id.get(val_attr))
+            for num_id in get_elements(self.style_docx.styles, '//w:numId'))
 
         nums = [num for num_id, num in self._nums if num_id in used_num_ids]
         get_abst_num_id = lambda num: int(
@@ -2106,7 +2914,7 @@ class DocxComposer: # pylint: disable=too-many-public-methods
             bullet_id = elem.get(val_attr)
             num_pic_bullet_elems = get_elements(
                 self.style_docx.numbering,
-                'w:numPicBullet[@w:numPicBulletId="%s"]' % bullet_id)
+                'w:numPicBullet[@w:numPicBulletId=$id]', id=bullet_id)
             if num_pic_bullet_elems:
                 numbering.insert(0, num_pic_bullet_elems[-1])
         return numbering
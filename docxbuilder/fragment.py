@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+    Fragments translated from included documents, which are reused across
+    builds and passed from the processes translating chapters in parallel.
+"""
+
+import contextlib
+import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import re
+
+try:
+    from shutil import which
+except ImportError: # Python 2
+    from distutils.spawn import find_executable as which
+
+from docutils import nodes
+from sphinx import addnodes
+from sphinx.ext import graphviz
+from sphinx.util import logging
+
+from docxbuilder import docx, trace
+from docxbuilder.cache import get_file_stat
+from docxbuilder.version import __version__
+
+# Version of the layout of TranslatedFragment, which is to be changed when
+# the layout or the journal entries of fragments change
+FRAGMENT_FORMAT_VERSION = 1
+
+# Loggers used while translating, whose logs TranslatorLogFilter drops
+TRANSLATOR_LOGGER_NAMES = (
+    'docxbuilder', 'sphinx.highlighting', 'sphinx.ext.graphviz')
+
+def make_node_digest(node):
+    """Make a digest from the contents of the node and its descendants
+    """
+    md5 = hashlib.md5()
+    for child in node.traverse():
+        if isinstance(child, nodes.Text):
+            md5.update(('#text:%s\n' % child.astext()).encode('utf8'))
+            continue
+        md5.update(('%s:%d:%r\n' % (
+            child.tagname, len(child.children),
+            sorted(child.attributes.items()))).encode('utf8'))
+        if isinstance(child, nodes.FixedTextElement):
+            md5.update(('#raw:%s\n' % child.rawsource).encode('utf8'))
+    return md5.hexdigest()
+
+def has_lazy_start_of_file(node):
+    """Return true if the node contains start_of_file nodes whose contents
+    are not loaded yet
+    """
+    return any(
+        child.get('docx_lazy') for child
+        in node.traverse(addnodes.start_of_file, include_self=False))
+
+def is_chapter(node):
+    """Return true if the node is a start_of_file node which is not contained
+    in another start_of_file node
+    """
+    if not isinstance(node, addnodes.start_of_file):
+        return False
+    parent = node.parent
+    while parent is not None:
+        if isinstance(parent, addnodes.start_of_file):
+            return False
+        parent = parent.parent
+    return True
+
+def traverse_contents(node, condition, include_chapters):
+    """Traverse the descendants of the node which match the condition,
+    excluding the contents of the chapters unless include_chapters is true
+    """
+    result = []
+    pending = [node]
+    while pending:
+        child = pending.pop()
+        if child is not node and not include_chapters and is_chapter(child):
+            continue
+        if isinstance(child, condition):
+            result.append(child)
+        if isinstance(child, nodes.Element):
+            pending.extend(reversed(child.children))
+    return result
+
+def count_chapters(document):
+    """Return the number of the chapters, which are start_of_file nodes
+    at the top level, in the document
+    """
+    return sum(1 for _node in document.traverse(is_chapter))
+
+def make_graphviz_key(node):
+    """Return the key of the image rendered from the graphviz node"""
+    return hashlib.md5(repr(
+        (node['code'], sorted(node['options'].items()))
+    ).encode('utf-8')).hexdigest()
+
+class TranslatorLogFilter(object):
+    """Logging filter to drop logs while logs_enabled of the fragment
+    manager is false
+    """
+
+    def __init__(self, manager):
+        self._manager = manager
+
+    def filter(self, _record):
+        return self._manager.logs_enabled
+
+class FragmentRecord(object):
+    def __init__(self, start):
+        self.start = start
+        # Elements, or their serialized strings if they have been flushed
+        self.elements = []
+        self.num_serialized = 0
+        self.removes_last_table_bottom_margin = False
+
+    def serialize_flushed(self, count, serialized):
+        """Serialize the elements of the first count elements of the body,
+        which have been flushed, in order not to hold them in memory
+
+        serialized is a dictionary from elements to their strings shared by
+        the records.
+        """
+        end = min(len(self.elements), count - self.start)
+        for index in range(self.num_serialized, end):
+            elem = self.elements[index]
+            xml = serialized.get(elem)
+            if xml is None:
+                xml = serialized[elem] = docx.tostring(elem)
+            self.elements[index] = xml
+        self.num_serialized = max(self.num_serialized, end)
+
+class TranslatedFragment(object):
+    def __init__(self, fragment, state_info, language, linenothreshold):
+        self.fragment = fragment
+        self.state_info = state_info
+        self.language = language
+        self.linenothreshold = linenothreshold
+        self.images = [
+            (path, get_file_stat(path)) for path in fragment.get_image_paths()
+        ]
+
+    def is_valid(self):
+        """Return true if the images used in the fragment are not changed"""
+        return all(get_file_stat(path) == stat for path, stat in self.images)
+
+class FragmentManager(object):
+    """State of a translator about the fragments and the chapters
+
+    The contents of start_of_file nodes are stored in the fragment cache of
+    the builder, and inserted from it instead of being translated again.
+    If translate_chapters is called, only the given chapters are translated,
+    and the logs are dropped while logs_enabled is false. The graphviz
+    images and the equations are prepared in advance only in the contents
+    which are to be translated.
+    """
+
+    def __init__(self, translator, numsec_map, numfig_map):
+        self._translator = translator
+        self._builder = translator.builder
+        self._numsec_map = numsec_map
+        self._numfig_map = numfig_map
+        self.cache = self._builder.fragment_cache
+        self._stack = [] # (start_of_file node, cache key)
+        self._key_base = None
+        self._graphviz_files = {} # key => (filepath, exception)
+        self._chapter_index = -1
+        self._chapters = None # indices of the chapters translated if not all
+        self._chapter_keys = {} # chapter index => fragment key
+        # Whether the graphviz images and the equations of the chapters are
+        # prepared when the chapters are translated, not in prepare_document
+        self._prepares_chapters = False
+        # Fragment keys of the chapters translated by translate_chapters
+        self._translated_chapter_keys = (
+            self._builder.translated_chapter_keys or {})
+        self.logs_enabled = True
+
+    def translate_chapters(self, chapters):
+        """Translate only the chapters whose indices are in chapters, and
+        return a dictionary from the indices to the keys of the fragments
+        stored in the fragment cache
+
+        The logs issued outside of the fragments are dropped. The fragment
+        keys are to be set to translated_chapter_keys of the builder,
+        so that the translator for the whole document does not issue
+        the logs again.
+        """
+        self._chapters = chapters
+        self.logs_enabled = False
+        with self.filtering_logs(), trace.span('translate_chapters'):
+            self._translator.document.walkabout(self._translator)
+        return self._chapter_keys
+
+    @contextlib.contextmanager
+    def filtering_logs(self):
+        """Drop the logs issued by the translator while logs_enabled is false
+        in the context
+
+        Only the loggers in TRANSLATOR_LOGGER_NAMES are filtered, so that
+        the logs of other extensions are kept.
+        """
+        log_filter = TranslatorLogFilter(self)
+        loggers = [
+            logging.getLogger(name).logger for name in TRANSLATOR_LOGGER_NAMES]
+        for logger in loggers:
+            logger.addFilter(log_filter)
+        try:
+            yield
+        finally:
+            for logger in loggers:
+                logger.removeFilter(log_filter)
+
+    def enter_chapter(self):
+        """Count the chapter which starts, and return true if it is to be
+        translated
+        """
+        self._chapter_index += 1
+        return self._chapters is None or self._chapter_index in self._chapters
+
+    def leave_chapter(self):
+        self.logs_enabled = self._chapters is None
+
+    def begin(self, node, key, is_chapter_node):
+        """Begin the fragment of the node, which is stored with the key"""
+        self._stack.append((node, key))
+        if is_chapter_node and self._chapters is not None:
+            self._chapter_keys[self._chapter_index] = key
+            self.logs_enabled = True
+        elif is_chapter_node:
+            # The logs have been issued by translate_chapters
+            self.logs_enabled = (
+                self._chapter_index not in self._translated_chapter_keys)
+
+    def end(self, node):
+        """Return the key of the fragment of the node, or None if the node
+        does not begin a fragment
+        """
+        if self._stack and self._stack[-1][0] is node:
+            return self._stack.pop()[1]
+        return None
+
+    def make_key(self, node, state):
+        """Make the key of the fragment of the node, which is translated from
+        the state of the translator
+        """
+        if self._key_base is None:
+            md5 = hashlib.md5()
+            md5.update(self._builder.get_config_digest().encode('utf8'))
+            md5.update(('%s:%d' % (
+                __version__, FRAGMENT_FORMAT_VERSION
+            )).encode('utf8'))
+            md5.update(repr((
+                sorted(self._numsec_map.items()),
+                sorted((figtype, prefix, sorted(num_map.items()))
+                       for figtype, (prefix, num_map)
+                       in self._numfig_map.items()),
+                sorted(self._builder.env.all_docs),
+            )).encode('utf8'))
+            self._key_base = md5.hexdigest()
+        md5 = hashlib.md5()
+        md5.update(self._key_base.encode('utf8'))
+        md5.update(repr(state).encode('utf8'))
+        md5.update(make_node_digest(node).encode('utf8'))
+        md5.update(self._get_toctree_docnames_digest(node).encode('utf8'))
+        return md5.hexdigest()
+
+    def _get_toctree_docnames_digest(self, node):
+        """Make a digest from the documents whose titles may be referred by
+        the table of contents in the node
+        """
+        env = self._builder.env
+        docnames = set()
+        pending = [
+            docname for toctree in node.traverse(addnodes.toctree)
+            for docname in toctree.get('includefiles', [])
+        ]
+        while pending:
+            docname = pending.pop()
+            if docname in docnames:
+                continue
+            docnames.add(docname)
+            pending.extend(env.toctree_includes.get(docname, []))
+        md5 = hashlib.md5()
+        for docname in sorted(docnames):
+            md5.update(('%s:%r\n' % (
+                docname, env.all_docs.get(docname))).encode('utf8'))
+        return md5.hexdigest()
+
+    def prepare_document(self, node):
+        """Prepare the contents of the document node, except for the chapters
+        which may be inserted from fragments
+        """
+        self._prepares_chapters = (
+            self.cache is not None or self._chapters is not None
+            or bool(self._translated_chapter_keys))
+        self._prepare_contents(node, not self._prepares_chapters)
+
+    def prepare_start_of_file(self, node, is_chapter_node):
+        """Prepare the contents of the start_of_file node to be translated,
+        unless they have been prepared with the document
+        """
+        if node.get('docx_lazy') or (
+                is_chapter_node and self._prepares_chapters):
+            self._prepare_contents(node, True)
+
+    def get_graphviz_file(self, node):
+        """Return the image file rendered from the graphviz node in advance
+        and the exception raised by the rendering, or (None, None) if it has
+        not been rendered
+        """
+        return self._graphviz_files.get(make_graphviz_key(node), (None, None))
+
+    def _prepare_contents(self, node, include_chapters):
+        """Render the graphviz images and convert the equations under the node
+        in advance
+        """
+        self._render_graphviz_images(node, include_chapters)
+        self._convert_equations(node, include_chapters)
+
+    def _render_graphviz_images(self, node, include_chapters):
+        """Render the graphviz nodes under the node concurrently in advance
+
+        visit_graphviz looks up the rendered images by get_graphviz_file.
+        """
+        items = []
+        keys = set(self._graphviz_files)
+        for graph in traverse_contents(
+                node, graphviz.graphviz, include_chapters):
+            key = make_graphviz_key(graph)
+            if key not in keys:
+                keys.add(key)
+                items.append((key, graph))
+        if len(items) < 2:
+            return # visit_graphviz renders it
+        if which(self._builder.config.graphviz_dot) is None:
+            return # visit_graphviz warns that dot command is not available
+        with trace.span('render_graphviz', graphs=len(items)):
+            self._render_graphviz_items(items)
+
+    def _render_graphviz_items(self, items):
+        def render(item):
+            key, graph = item
+            try:
+                _fname, filepath = graphviz.render_dot(
+                    self._translator, graph['code'], graph['options'], 'png')
+                return key, (filepath, None)
+            except Exception as e: # pylint: disable=broad-except
+                return key, (None, e)
+
+        nproc = min(multiprocessing.cpu_count(), len(items))
+        pool = ThreadPool(nproc)
+        try:
+            self._graphviz_files.update(pool.imap_unordered(render, items))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _convert_equations(self, node, include_chapters):
+        """Convert the equations under the node in parallel processes in
+        advance if docx_math_jobs is not 1
+        """
+        nproc = self._builder.config.docx_math_jobs
+        if nproc == 1:
+            return
+        equations = [
+            math_node.get('latex', math_node.astext()) for math_node
+            in traverse_contents(node, nodes.math, include_chapters)]
+        for math_node in traverse_contents(
+                node, nodes.math_block, include_chapters):
+            equations.extend(re.split(r'\n{2,}', math_node.astext()))
+        with trace.span('convert_equations', equations=len(equations)):
+            self._builder.math_cache.convert(
+                equations, nproc or multiprocessing.cpu_count())
@@ -1,6 +1,10 @@
-from xml.sax import saxutils
+import collections
+import hashlib
+import logging
+import pygments
 from pygments.formatter import Formatter
 from sphinx.highlighting import PygmentsBridge
+from sphinx.util import logging as sphinx_logging
 
 # Not use achromatic colors, which are unsuitable for highlight
 HIGHLIGHT_COLOR_MAP = {
@@ -36,125 +40,161 @@ def get_highlight_color_name(hex_highlight_color):
         key=lambda name_and_dist: name_and_dist[1])
     return color_name
 
+def get_run_properties(style):
+    """Get the tag names and attributes of the run properties for
+    the style of a token.
+    """
+    props = []
+    if style['bgcolor']:
+        props.append(('w:shd', {'w:themeFill': style['bgcolor']}))
+    if style['color']:
+        props.append(('w:color', {'w:val': style['color']}))
+    if style['bold']:
+        props.append(('w:b', {}))
+    if style['italic']:
+        props.append(('w:i', {}))
+    if style['underline']:
+        props.append(('w:u', {}))
+    if style['border']:
+        props.append(('w:bdr', collections.OrderedDict([
+            ('w:val', 'single'), ('w:space', '0'),
+            ('w:color', style['border'])])))
+    return tuple(props)
+
+class HighlightedCode(object):
+    """Highlighted lines of code.
+
+    Each line is a list of pairs of a text and its run properties, which are
+    given by get_run_properties.
+    """
+
+    def __init__(self, lines, background_color, linenostart):
+        self.lines = lines
+        self.background_color = background_color
+        self.linenostart = linenostart
+
 class DocxFormatter(Formatter):
+    """Formatter to WordprocessingML.
+
+    Nothing is written, and the lines are kept in highlighted as
+    HighlightedCode instead, from which the writer makes the elements.
+    """
+
     def __init__(self, **options):
         super(DocxFormatter, self).__init__(**options)
-        self.linenos = options.get('linenos', False)
         self.hl_lines = options.get('hl_lines', [])
         self.linenostart = options.get('linenostart', 1)
         self.trim_last_line_break = options.get('trim_last_line_break', False)
         self.highlight = get_highlight_color_name(self.style.highlight_color)
+        self.highlighted = None
+        self._run_properties = {} # token type => run properties
 
     def format_unencoded(self, tokensource, outfile):
-        # pylint: disable=too-many-branches
+        # pylint: disable=unused-argument
         lines = [[]]
         for ttype, value in tokensource:
             if value == '\n':
                 lines.append([])
-            else:
-                while not self.style.styles_token(ttype) and ttype.parent:
-                    ttype = ttype.parent
-                style = self.style.style_for_token(ttype)
-                buf = []
-                if style['bgcolor']:
-                    buf.append(r'<w:shd w:themeFill="%s" />' % style['bgcolor'])
-                if style['color']:
-                    buf.append(r'<w:color w:val="%s" />' % style['color'])
-                if style['bold']:
-                    buf.append(r'<w:b />')
-                if style['italic']:
-                    buf.append(r'<w:i />')
-                if style['underline']:
-                    buf.append(r'<w:u />')
-                if style['border']:
-                    buf.append(r'<w:bdr w:val="single" w:space="0" w:color="%s" />' %
-                               style['border'])
-
-                style = ''.join(buf)
-                value = saxutils.escape(value)
-                index = 0
-                while index < len(value):
-                    idx = value.find('\n', index)
-                    if idx == -1:
-                        lines[-1].append((value[index:], style))
-                        break
-                    else:
-                        lines[-1].append((value[index:idx], style))
-                        lines.append([])
-                        index = idx + 1
+                continue
+            props = self._get_run_properties(ttype)
+            index = 0
+            while index < len(value):
+                idx = value.find('\n', index)
+                if idx == -1:
+                    lines[-1].append((value[index:], props))
+                    break
+                else:
+                    lines[-1].append((value[index:idx], props))
+                    lines.append([])
+                    index = idx + 1
 
         if self.trim_last_line_break and lines[-1] == []:
             lines.pop()
 
-        if self.linenos:
-            self.output_as_table_with_linenos(outfile, lines)
-        else:
-            self.output_as_paragraph(outfile, lines)
-
-    def output_as_paragraph(self, outfile, lines):
-        outfile.write(
-            '<w:p xmlns:w='
-            '"http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
-            '>')
-        outfile.write(
-            '<w:pPr>'
-            '<w:shd w:val="clear" w:color="auto" w:fill="%s"/>'
-            '</w:pPr>' % self.style.background_color[1:7])
-        for lineno, tokens in enumerate(lines, 1):
-            self.output_line(outfile, lineno, tokens)
-            if lineno != len(lines):
-                outfile.write(r'<w:r><w:br /></w:r>')
-        outfile.write('</w:p>')
-
-    def output_as_table_with_linenos(self, outfile, lines):
-        outfile.write(
-            '<w:tbl xmlns:w='
-            '"http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
-            '>')
-        bgcolor = self.style.background_color[1:7]
-        for lineno, tokens in enumerate(lines, 1):
-            outfile.write('<w:tr>')
-            outfile.write('<w:tc><w:p>')
-            outfile.write('<w:pPr><w:shd w:val="clear"/></w:pPr>')
-            outfile.write(
-                '<w:r><w:t>%d</w:t></w:r>' % (self.linenostart + lineno - 1))
-            outfile.write('</w:p></w:tc>')
-            outfile.write('<w:tc><w:p>')
-            outfile.write(
-                '<w:pPr>'
-                '<w:shd w:val="clear" w:color="auto" w:fill="%s"/>'
-                '</w:pPr>' % bgcolor)
-            self.output_line(outfile, lineno, tokens)
-            outfile.write('</w:p></w:tc>')
-            outfile.write('</w:tr>')
-        outfile.write('</w:tbl>')
-
-    def output_line(self, outfile, lineno, tokens):
-        for text, style in tokens:
-            outfile.write(r'<w:r>')
-            if lineno in self.hl_lines:
-                style += r'<w:highlight w:val="%s" />' % self.highlight
-            if style:
-                outfile.write(r'<w:rPr>%s</w:rPr>' % style)
-            if text.find(' ') != -1:
-                outfile.write(r'<w:t xml:space="preserve">')
-            else:
-                outfile.write(r'<w:t>')
-            outfile.write(text)
-            outfile.write(r'</w:t>')
-            outfile.write(r'</w:r>')
+        highlight = (('w:highlight', {'w:val': self.highlight}),)
+        for lineno in set(self.hl_lines):
+            if 0 < lineno <= len(lines):
+                lines[lineno - 1] = [
+                    (text, props + highlight)
+                    for text, props in lines[lineno - 1]]
+
+        self.highlighted = HighlightedCode(
+            lines, self.style.background_color[1:7], self.linenostart)
+
+    def _get_run_properties(self, ttype):
+        props = self._run_properties.get(ttype)
+        if props is None:
+            style_type = ttype
+            while not self.style.styles_token(style_type) and style_type.parent:
+                style_type = style_type.parent
+            props = get_run_properties(self.style.style_for_token(style_type))
+            self._run_properties[ttype] = props
+        return props
+
+class WarningCounter(logging.Filter):
+    """Filter to count warnings logged"""
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.count = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            self.count += 1
+        return True
 
 class DocxPygmentsBridge(PygmentsBridge):
-    def __init__(self, dest, stylename, trim_doctest_flags=None):
+    """PygmentsBridge returning HighlightedCode.
+
+    If cache is not None, the results are looked up in and stored to it.
+    Results whose highlighting issues warnings are not cached, so that
+    the warnings are issued every time.
+    """
+
+    def __init__(self, dest, stylename, trim_doctest_flags=None, cache=None):
         if trim_doctest_flags is not None:
             PygmentsBridge.__init__(self, dest, stylename, trim_doctest_flags)
         else:
             PygmentsBridge.__init__(self, dest, stylename)
         self.formatter = DocxFormatter
+        self._formatter = None
+        self._cache = cache
+        self._key_base = repr(
+            (stylename, trim_doctest_flags, pygments.__version__))
+
+    def get_formatter(self, **kwargs):
+        self._formatter = PygmentsBridge.get_formatter(self, **kwargs)
+        return self._formatter
 
     def highlight_block(self, source, lang, *args, **kwargs):
+        """Highlight the code, and return HighlightedCode"""
         # pylint: disable=arguments-differ
         # highlight_block may append a line break to the tail of the code
         kwargs['trim_last_line_break'] = not source.endswith('\n')
-        return super(DocxPygmentsBridge, self).highlight_block(
-            source, lang, *args, **kwargs)
+        key = None
+        if self._cache is not None:
+            key = self._make_cache_key(source, lang, args, kwargs)
+            highlighted = self._cache.get(key)
+            if highlighted is not None:
+                return highlighted
+        counter = WarningCounter()
+        logger = sphinx_logging.getLogger('sphinx.highlighting').logger
+        logger.addFilter(counter)
+        try:
+            super(DocxPygmentsBridge, self).highlight_block(
+                source, lang, *args, **kwargs)
+        finally:
+            logger.removeFilter(counter)
+        highlighted = self._formatter.highlighted
+        if key is not None and counter.count == 0:
+            self._cache.put(key, highlighted)
+        return highlighted
+
+    def _make_cache_key(self, source, lang, args, kwargs):
+        options = sorted(
+            (name, sorted(value.items()) if isinstance(value, dict) else value)
+            for name, value in kwargs.items()
+            if name not in ('location', 'warn'))
+        return hashlib.md5(repr(
+            (self._key_base, source, lang, args, options)
+        ).encode('utf-8')).hexdigest()
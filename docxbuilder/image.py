@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+    Metadata of image files, which is cached across builds.
+"""
+
+import math
+import multiprocessing
+import os
+
+from sphinx.util.osutil import ensuredir
+
+from docxbuilder import docx
+from docxbuilder.cache import CountedCache, get_file_stat
+
+# Is the PIL imaging library installed?
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class ImageInfo(object):
+    """Intrinsic size in pixels, resolution and format of an image"""
+
+    def __init__(self, width, height, dpi, image_format):
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+        self.format = image_format
+
+    def get_cm_size(self):
+        cmperin = 2.54
+        return (self.width * cmperin / self.dpi[0],
+                self.height * cmperin / self.dpi[1])
+
+def read_image_info(filename):
+    if Image is None:
+        raise RuntimeError(
+            'image size not fully specified and PIL not installed')
+    with Image.open(filename, 'r') as imageobj:
+        dpi = imageobj.info.get('dpi', (72, 72))
+        # dpi information can be (xdpi, ydpi) or xydpi
+        try:
+            iter(dpi)
+        except StopIteration:
+            dpi = (dpi, dpi)
+        return ImageInfo(
+            imageobj.size[0], imageobj.size[1], tuple(dpi), imageobj.format)
+
+
+class ImageInfoCache(CountedCache):
+    """Cache of ImageInfo and digests of contents keyed by the path, mtime
+    and size of image files
+
+    If filename is None, the cache is not persisted.
+    """
+
+    def get(self, filename): # pylint: disable=arguments-renamed
+        return self._get(filename, 'info', read_image_info)
+
+    def get_digest(self, filename):
+        return self._get(filename, 'digest', docx.get_file_digest)
+
+    def _get(self, filename, kind, read):
+        path = os.path.abspath(filename)
+        key = (kind, path, get_file_stat(path))
+        return self.get_or_make(key, lambda: read(path))
+
+
+# Formats of images which are downscaled
+RESAMPLED_FORMATS = {'JPEG': '.jpeg', 'PNG': '.png'}
+
+def get_resampled_size(info, cm_size, max_dpi):
+    """Return the size in pixels to which the image displayed with cm_size
+    is downscaled at max_dpi, or None if the image is small enough
+    """
+    cmperin = 2.54
+    scale = max(
+        cm_size[0] / cmperin * max_dpi / info.width,
+        cm_size[1] / cmperin * max_dpi / info.height)
+    if scale >= 1:
+        return None
+    return (max(1, int(math.ceil(info.width * scale))),
+            max(1, int(math.ceil(info.height * scale))))
+
+def resample_image(task):
+    """Downscale the image, and return an error message if it fails"""
+    source, dest, size, quality = task
+    tmpname = '%s.%d.tmp' % (dest, os.getpid())
+    try:
+        with Image.open(source, 'r') as imageobj:
+            image_format = imageobj.format
+            resized = imageobj.resize(size, Image.LANCZOS)
+            # The color profile and the metadata are kept
+            options = dict(
+                (name, imageobj.info[name]) for name in ('icc_profile', 'exif')
+                if imageobj.info.get(name))
+            if image_format == 'JPEG':
+                options['quality'] = quality
+            else:
+                options['optimize'] = True
+            resized.save(tmpname, image_format, **options)
+        docx.replace_file(tmpname, dest)
+    except Exception as e: # pylint: disable=broad-except
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        return '%s: %s' % (source, e)
+    return None
+
+
+class ImageResampler(object):
+    """Downscaler of images to the sizes with which they are displayed
+
+    The downscaled images are kept in cachedir, and reused while the contents
+    of the original images are not changed. The modification times of reused
+    images are updated, so that remove_unused can find images not used.
+    The process pool to downscale images is shared by the calls of resample,
+    and close should be called to terminate it.
+    """
+
+    def __init__(self, cachedir, max_dpi, quality, image_cache, nproc=None):
+        self._cachedir = cachedir
+        self._max_dpi = max_dpi
+        self._quality = quality
+        self._image_cache = image_cache
+        self._nproc = nproc or multiprocessing.cpu_count()
+        self._pool = None
+        self._pool_pid = None # The pool is not usable in forked processes
+
+    def resample(self, display_sizes):
+        """Downscale the images of display_sizes, which maps the paths of
+        images to their sizes in cm, and return a dictionary from the paths
+        to the downscaled files, which are smaller than the originals,
+        and a list of error messages
+        """
+        if Image is None:
+            return {}, []
+        files = {}
+        tasks = []
+        for path, cm_size in display_sizes.items():
+            try:
+                info = self._image_cache.get(path)
+            except Exception: # pylint: disable=broad-except
+                continue
+            ext = RESAMPLED_FORMATS.get(info.format)
+            size = get_resampled_size(info, cm_size, self._max_dpi)
+            if ext is None or size is None:
+                continue
+            dest = os.path.join(self._cachedir, '%s_%dx%d_%d%s' % (
+                self._image_cache.get_digest(path),
+                size[0], size[1], self._quality, ext))
+            if os.path.exists(dest):
+                os.utime(dest, None)
+            else:
+                tasks.append((path, dest, size, self._quality))
+            files[path] = dest
+        errors = self._run(tasks)
+        return dict(
+            (path, dest) for path, dest in files.items()
+            if os.path.exists(dest)
+            and os.path.getsize(dest) < os.path.getsize(path)
+        ), errors
+
+    def _run(self, tasks):
+        if not tasks:
+            return []
+        ensuredir(self._cachedir)
+        pool = self._get_pool() if len(tasks) > 1 else None
+        if pool is not None:
+            results = pool.map(resample_image, tasks)
+        else:
+            results = [resample_image(task) for task in tasks]
+        return [error for error in results if error is not None]
+
+    def _get_pool(self):
+        if self._nproc <= 1:
+            return None
+        if self._pool is None or self._pool_pid != os.getpid():
+            try:
+                # pylint: disable=consider-using-with
+                self._pool = multiprocessing.Pool(self._nproc)
+            except (AssertionError, OSError):
+                # e.g. daemonic processes are not allowed to have children
+                self._pool = None
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def close(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
+
+    def remove_unused(self, since):
+        """Remove the downscaled images which are not used since the time"""
+        if not os.path.isdir(self._cachedir):
+            return
+        for name in os.listdir(self._cachedir):
+            path = os.path.join(self._cachedir, name)
+            try:
+                if os.path.getmtime(path) < since:
+                    os.remove(path)
+            except OSError:
+                pass
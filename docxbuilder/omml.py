@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+    Conversion of LaTeX equations to OMML, which is cached across builds.
+"""
+
+import collections
+import copy
+import multiprocessing
+import os
+
+from docxbuilder import docx
+from docxbuilder.cache import CountedCache
+
+# Is the math libraries installed?
+try:
+    import html.entities
+    import mathml2omml
+    import latex2mathml.converter
+
+    ENTITIES = {'dtdot': 0x22f1, 'midot': 0x00b7}
+    ENTITIES.update(html.entities.name2codepoint)
+    HAS_MATH_LIBRARIES = True
+
+    def latex2omml_string(latex):
+        mathml = latex2mathml.converter.convert(latex)
+        return mathml2omml.convert(mathml, ENTITIES)
+except ImportError:
+    HAS_MATH_LIBRARIES = False
+
+def convert_equation(latex):
+    """Return the OMML string converted from latex, or None if it fails"""
+    try:
+        return latex2omml_string(latex)
+    except Exception: # pylint: disable=broad-except
+        return None
+
+
+class OmmlCache(CountedCache):
+    """Cache of OMML elements converted from LaTeX equations
+
+    The parsed elements of up to maxsize recently used equations are kept in
+    memory, and the OMML strings are persisted in filename unless it is None.
+    The process pool to convert equations is shared by the calls of convert,
+    and close should be called to terminate it.
+    """
+
+    def __init__(self, filename=None, maxsize=1024):
+        CountedCache.__init__(self, filename)
+        self._elements = collections.OrderedDict()
+        self._maxsize = maxsize
+        self._converted = {} # latex => OMML string converted in advance
+        self._pool = None
+        self._pool_pid = None # The pool is not usable in forked processes
+
+    def get(self, latex): # pylint: disable=arguments-renamed
+        """Return a copy of the OMML element converted from latex"""
+        if not HAS_MATH_LIBRARIES:
+            return docx.make_omath_run(latex)
+        elem = self._elements.pop(latex, None)
+        if elem is not None:
+            self.hits += 1
+        else:
+            elem = docx.fromstring(self._get_string(latex))[0]
+            if len(self._elements) >= self._maxsize:
+                self._elements.popitem(last=False)
+        self._elements[latex] = elem
+        return copy.copy(elem) # lxml elements are copied deeply
+
+    def _get_string(self, latex):
+        def convert():
+            omml = self._converted.pop(latex, None)
+            if omml is None:
+                omml = latex2omml_string(latex)
+            return omml
+        return self.get_or_make(('omml', latex), convert)
+
+    def convert(self, equations, nproc):
+        """Convert the equations which are not cached yet in nproc processes
+        in advance
+
+        Equations which fail to be converted are left to get, which raises
+        the error.
+        """
+        if not HAS_MATH_LIBRARIES or nproc <= 1:
+            return
+        pending = [
+            latex for latex in set(equations)
+            if latex not in self._elements and latex not in self._converted
+            and ('omml', latex) not in self
+        ]
+        if len(pending) < 2:
+            return
+        pool = self._get_pool(nproc)
+        if pool is None:
+            return
+        results = pool.map(convert_equation, pending)
+        for latex, omml in zip(pending, results):
+            if omml is not None:
+                self._converted[latex] = omml
+
+    def _get_pool(self, nproc):
+        if self._pool is None or self._pool_pid != os.getpid():
+            try:
+                # pylint: disable=consider-using-with
+                self._pool = multiprocessing.Pool(nproc)
+            except (AssertionError, OSError):
+                # e.g. daemonic processes are not allowed to have children
+                self._pool = None
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def close(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
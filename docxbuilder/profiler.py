@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+    Profiling of the visit and depart methods of translators per node class
+    and per source document, and of the memory usage at the build phases.
+"""
+
+import json
+import os
+import sys
+from timeit import default_timer
+
+from docutils import nodes
+from sphinx import addnodes
+
+# tracemalloc is available from Python 3.4
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# resource is available only on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class VisitorProfiler(object):
+    """Accumulator of the call counts and the times spent on the nodes
+    dispatched to translators
+
+    The inclusive time of a node is from the start of the visit to the end of
+    the departure, which includes the times of its children, and
+    the exclusive time excludes them. The inclusive times of nodes nested in
+    nodes of the same class are not counted twice. Nodes are attributed to the innermost
+    source document, and unknown nodes are recorded with the class name
+    suffixed by " (unknown)". start_of_file nodes whose visits skip them,
+    which are not translated (e.g. replayed from the fragment cache or
+    translated in other processes), are not recorded.
+    """
+
+    def __init__(self):
+        # (docname, node class) => [count, inclusive time, exclusive time]
+        self._stats = {}
+        self._stack = [] # [(docname, node class), start time, children time]
+        self._inclusive = {} # node class => inclusive time
+        # (docname, node class) or node class => number of nodes in stack
+        self._depths = {}
+
+    def wrap(self, translator, docname_stack):
+        """Wrap dispatch_visit and dispatch_departure of the translator,
+        whose current source document is the last of docname_stack
+        """
+        dispatch_visit = translator.dispatch_visit
+        dispatch_departure = translator.dispatch_departure
+
+        def profiled_visit(node):
+            name = node.__class__.__name__
+            if not hasattr(translator, 'visit_' + name):
+                name += ' (unknown)'
+            if isinstance(node, (nodes.document, addnodes.start_of_file)):
+                docname = node.get('docname', '')
+            else:
+                docname = docname_stack[-1] if docname_stack else ''
+            key = (docname, name)
+            self._depths[key] = self._depths.get(key, 0) + 1
+            self._depths[name] = self._depths.get(name, 0) + 1
+            self._stack.append([key, default_timer(), 0.0])
+            try:
+                return dispatch_visit(node)
+            except (nodes.SkipChildren, nodes.StopTraversal):
+                raise # dispatch_departure is called
+            except nodes.SkipNode:
+                if isinstance(node, addnodes.start_of_file):
+                    self._discard()
+                else:
+                    self._end()
+                raise
+            except Exception:
+                self._end()
+                raise
+
+        def profiled_departure(node):
+            try:
+                return dispatch_departure(node)
+            finally:
+                self._end()
+
+        translator.dispatch_visit = profiled_visit
+        translator.dispatch_departure = profiled_departure
+
+    def _end(self):
+        key, start, children_time = self._stack.pop()
+        elapsed = default_timer() - start
+        stat = self._stats.get(key)
+        if stat is None:
+            stat = self._stats[key] = [0, 0.0, 0.0]
+        stat[0] += 1
+        stat[2] += elapsed - children_time
+        if self._leave(key):
+            stat[1] += elapsed
+        name = key[1]
+        if self._leave(name):
+            self._inclusive[name] = self._inclusive.get(name, 0.0) + elapsed
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def _discard(self):
+        """Pop the node without recording it, whose time is excluded from
+        the exclusive time of the parent
+        """
+        key, start, _ = self._stack.pop()
+        self._leave(key)
+        self._leave(key[1])
+        if self._stack:
+            self._stack[-1][2] += default_timer() - start
+
+    def _leave(self, depth_key):
+        """Return true if no node of depth_key remains in the stack"""
+        self._depths[depth_key] -= 1
+        return not self._depths[depth_key]
+
+    def get_stats(self):
+        return (
+            dict((key, list(stat)) for key, stat in self._stats.items()),
+            dict(self._inclusive))
+
+    def update(self, stats):
+        """Merge the stats of another profiler, which are returned by
+        get_stats
+        """
+        stats, inclusive = stats
+        for key, (count, key_inclusive, exclusive) in stats.items():
+            stat = self._stats.get(key)
+            if stat is None:
+                stat = self._stats[key] = [0, 0.0, 0.0]
+            stat[0] += count
+            stat[1] += key_inclusive
+            stat[2] += exclusive
+        for name, value in inclusive.items():
+            self._inclusive[name] = self._inclusive.get(name, 0.0) + value
+
+    def clear(self):
+        self._stats.clear()
+        del self._stack[:]
+        self._inclusive.clear()
+        self._depths.clear()
+
+    def get_node_class_stats(self):
+        """Return a list of the node classes, the counts, the inclusive times
+        and the exclusive times summed up over the documents, which is sorted
+        by the exclusive times in descending order
+        """
+        totals = {}
+        for (_, name), (count, _, exclusive) in self._stats.items():
+            total = totals.setdefault(
+                name, [0, self._inclusive.get(name, 0.0), 0.0])
+            total[0] += count
+            total[2] += exclusive
+        return sorted(
+            ((name,) + tuple(total) for name, total in totals.items()),
+            key=lambda stat: (-stat[3], stat[0]))
+
+    def format_table(self, num_rows):
+        """Return the lines of a table of the top num_rows node classes"""
+        lines = ['%-32s %10s %14s %14s' % (
+            'node class', 'count', 'inclusive (s)', 'exclusive (s)')]
+        for name, count, inclusive, exclusive in (
+                self.get_node_class_stats()[:num_rows]):
+            lines.append('%-32s %10d %14.3f %14.3f' % (
+                name, count, inclusive, exclusive))
+        return lines
+
+    def save(self, filename):
+        """Save the stats per node class and per source document as JSON"""
+        documents = {}
+        for (docname, name), (count, inclusive, exclusive) in sorted(
+                self._stats.items()):
+            documents.setdefault(docname, {})[name] = {
+                'count': count, 'inclusive': inclusive, 'exclusive': exclusive,
+            }
+        node_classes = [
+            {'name': name, 'count': count,
+             'inclusive': inclusive, 'exclusive': exclusive}
+            for name, count, inclusive, exclusive
+            in self.get_node_class_stats()
+        ]
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(filename, 'w') as f:
+            json.dump({'node_classes': node_classes, 'documents': documents},
+                      f, indent=1)
+
+
+def get_rss():
+    """Return the resident set size of the process in bytes, or None if it
+    is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def get_peak_rss():
+    """Return the peak resident set size of the process in bytes, or None
+    if it is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in kilobytes on other platforms
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MemoryProfiler(object):
+    """Recorder of the memory usage and the top allocation sites at the
+    phases of writing docx files
+
+    The allocations are traced by tracemalloc, which is started by the first
+    begin and stopped by stop, and only the RSS is recorded if tracemalloc is
+    not available. The memory allocated by lxml (libxml2) is not traced,
+    and is included only in the RSS.
+    """
+
+    def __init__(self, num_sites):
+        self._num_sites = num_sites
+        self._records = []
+        self._filename = None
+        self._started = False
+
+    def begin(self, filename):
+        """Set the docx filename of which the following phases are recorded"""
+        self._filename = filename
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+
+    def stop(self):
+        """Stop tracing if it is started by begin"""
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    def take_snapshot(self, phase):
+        """Record the memory usage after the phase, the peak traced memory
+        since the last snapshot and the top allocation sites
+        """
+        record = {
+            'filename': self._filename,
+            'phase': phase,
+            'rss': get_rss(),
+            'peak_rss': get_peak_rss(),
+        }
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            traced, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ))
+            record['traced'] = traced
+            record['traced_peak'] = peak
+            record['sites'] = [
+                {'site': '%s:%d' % (stat.traceback[0].filename,
+                                    stat.traceback[0].lineno),
+                 'size': stat.size, 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:self._num_sites]
+            ]
+            del snapshot
+            if hasattr(tracemalloc, 'reset_peak'): # Python 3.9 or later
+                tracemalloc.reset_peak()
+        self._records.append(record)
+
+    def get_records(self):
+        return list(self._records)
+
+    def add_records(self, records):
+        """Merge the records of another profiler"""
+        self._records.extend(records)
+
+    def clear(self):
+        del self._records[:]
+
+    def format_records(self):
+        """Return the lines which report the records"""
+        def to_mib(size):
+            return '-' if size is None else '%.1f MiB' % (size / 1048576.0)
+        lines = []
+        for record in self._records:
+            line = '%s after %s: rss %s, peak rss %s' % (
+                record['filename'], record['phase'],
+                to_mib(record['rss']), to_mib(record['peak_rss']))
+            if 'traced' in record:
+                line += ', traced %s, traced peak %s' % (
+                    to_mib(record['traced']), to_mib(record['traced_peak']))
+            lines.append(line)
+            for site in record.get('sites', []):
+                lines.append('  %10.1f KiB %8d blocks  %s' % (
+                    site['size'] / 1024.0, site['count'], site['site']))
+        return lines
+
+    def save(self, filename):
+        """Save the records as JSON"""
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(filename, 'w') as f:
+            json.dump({'snapshots': self._records}, f, indent=1)
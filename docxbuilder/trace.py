@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+    Tracing of build phases, which is saved in the Chrome trace event format.
+
+    Spans are recorded only while a tracer is started by start, and span
+    returns a context doing nothing otherwise.
+"""
+
+import json
+import os
+import threading
+import time
+
+
+class NullSpan(object):
+    """Span which records nothing"""
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SPAN = NullSpan()
+
+class Span(object):
+    """Span from the creation to the end call, which is recorded as
+    a complete event of the tracer
+
+    Spans can be used as contexts, which call end on exit.
+    """
+
+    def __init__(self, tracer, name, args):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+        self._start = time.time()
+
+    def end(self):
+        self._tracer.add_complete_event(
+            self._name, self._start, time.time(), self._args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.end()
+        return False
+
+class Tracer(object):
+    """Recorder of trace events
+
+    Timestamps are the wall clock times, so that events recorded in forked
+    processes can be merged.
+    """
+
+    def __init__(self):
+        self._events = []
+
+    def add_complete_event(self, name, start_time, end_time, args=None):
+        event = {
+            'name': name, 'cat': 'docx', 'ph': 'X',
+            'ts': int(start_time * 1e6),
+            'dur': int((end_time - start_time) * 1e6),
+            'pid': os.getpid(), 'tid': threading.current_thread().ident,
+        }
+        if args:
+            event['args'] = args
+        self._events.append(event)
+
+    def get_events(self):
+        return list(self._events)
+
+    def add_events(self, events):
+        self._events.extend(events)
+
+    def clear(self):
+        del self._events[:]
+
+    def save(self, filename):
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        events = sorted(self._events, key=lambda event: event['ts'])
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+_tracer = None # pylint: disable=invalid-name
+
+def start():
+    """Start recording spans"""
+    global _tracer # pylint: disable=global-statement,invalid-name
+    _tracer = Tracer()
+
+def stop():
+    """Stop recording spans, and return the tracer"""
+    global _tracer # pylint: disable=global-statement,invalid-name
+    tracer, _tracer = _tracer, None
+    return tracer
+
+def get_tracer():
+    """Return the current tracer, or None if tracing is not started"""
+    return _tracer
+
+def span(name, **args):
+    """Start a span of the name, whose arguments are shown in the trace
+    viewer
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return Span(_tracer, name, args)
+
+def get_events():
+    """Return the events recorded by the current tracer"""
+    if _tracer is None:
+        return []
+    return _tracer.get_events()
+
+def add_events(events):
+    """Merge the events recorded in another process"""
+    if _tracer is not None:
+        _tracer.add_events(events)
+
+def clear_events():
+    """Clear the events, e.g. inherited from the parent process"""
+    if _tracer is not None:
+        _tracer.clear()
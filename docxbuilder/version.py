@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""
+    Version of docxbuilder, which is kept apart from the package module so
+    that the modules of the package and setup.py can read it.
+"""
+
+__version__ = '1.2.0'
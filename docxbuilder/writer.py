@@ -33,29 +33,12 @@ from sphinx.ext import graphviz
 from sphinx.locale import admonitionlabels, _
 from sphinx.util import logging
 
-from docxbuilder import docx
+from docxbuilder import docx, trace
+from docxbuilder.fragment import (
+    FragmentManager, FragmentRecord, TranslatedFragment,
+    has_lazy_start_of_file)
 from docxbuilder.highlight import DocxPygmentsBridge
-
-# Is the PIL imaging library installed?
-try:
-    from PIL import Image
-except ImportError as exp:
-    Image = None
-
-# Is the math libraries installed?
-try:
-    import html.entities
-    import mathml2omml
-    import latex2mathml.converter
-
-    def latex2omml(latex):
-        mathml = latex2mathml.converter.convert(latex)
-        entities = {'dtdot': 0x22f1, 'midot': 0x00b7}
-        entities.update(html.entities.name2codepoint)
-        return docx.fromstring(mathml2omml.convert(mathml, entities))[0]
-except ImportError:
-    def latex2omml(latex):
-        return docx.make_omath_run(latex)
+from docxbuilder.version import __version__
 
 # Utility functions
 
@@ -65,21 +48,12 @@ def is_sphinx_version_lower_than(version):
     major, minor, patch, _, _ = version_info
     return (major, minor, patch) < version
 
-def get_image_size(filename):
-    if Image is None:
-        raise RuntimeError(
-            'image size not fully specified and PIL not installed')
-    with Image.open(filename, 'r') as imageobj:
-        dpi = imageobj.info.get('dpi', (72, 72))
-        # dpi information can be (xdpi, ydpi) or xydpi
-        try:
-            iter(dpi)
-        except StopIteration:
-            dpi = (dpi, dpi)
-        width = imageobj.size[0]
-        height = imageobj.size[1]
-        cmperin = 2.54
-        return (width * cmperin / dpi[0], height * cmperin / dpi[1])
+def get_style_file_path(builder):
+    stylefile = builder.config['docx_style']
+    if stylefile:
+        return os.path.join(builder.confdir, os.path.join(stylefile))
+    # Use default style file
+    return os.path.join(os.path.dirname(__file__), 'docx/style.docx')
 
 def convert_to_twip_size(size_with_unit, max_width):
     if size_with_unit is None:
@@ -175,9 +149,23 @@ class DocxWriter(writers.Writer):
 
     def translate(self):
         visitor = self.builder.create_translator(self.document, self.builder)
-        self.document.walkabout(visitor)
+        with visitor.fragments.filtering_logs(), trace.span('translate'):
+            self.document.walkabout(visitor)
         self.output = visitor.asbytes()
 
+    def save(self, document, filename):
+        """Translate the document, and write the docx file to filename
+        without making the whole docx binary in memory
+        """
+        self.document = document
+        visitor = self.builder.create_translator(self.document, self.builder)
+        with visitor.fragments.filtering_logs(), trace.span('translate'):
+            self.document.walkabout(visitor)
+        memory_profiler = self.builder.memory_profiler
+        if memory_profiler is not None:
+            memory_profiler.take_snapshot('translation')
+        visitor.save(filename)
+
 #
 #  DocxTranslator class for sphinx
 #
@@ -258,12 +246,8 @@ class Paragraph(ParagraphElement):
             docx.make_inline_picture_run(
                 rid, picid, filename, width, height, alt))
 
-    def add_math(self, equation):
-        try:
-            self._contents_stack[-1].append(latex2omml(equation))
-        except:
-            self._contents_stack[-1].append(docx.make_omath_run(equation))
-            raise
+    def add_math(self, omath):
+        self._contents_stack[-1].append(omath)
 
     def add_footnote_reference(self, footnote_id, style_id):
         self._contents_stack[-1].append(
@@ -580,6 +564,18 @@ class SectionPropertyManager(object):
         self._last_section = None
         return section_prop, self._no_title_page[1]
 
+    def get_state(self):
+        return (self._current_orient,
+                tuple(sorted(self._current_sect_index.items())),
+                self._last_section, tuple(self._no_title_page))
+
+    def set_state(self, state):
+        orient, sect_index, last_section, no_title_page = state
+        self._current_orient = orient
+        self._current_sect_index = dict(sect_index)
+        self._last_section = last_section
+        self._no_title_page = list(no_title_page)
+
     @property
     def _current_section(self):
         current_orient = self._current_orient
@@ -587,11 +583,13 @@ class SectionPropertyManager(object):
         return (current_orient, current_index)
 
 class Document(object):
-    def __init__(self, body, default_orient, sect_props):
+    def __init__(self, body, default_orient, sect_props, flush_body=None):
         self._body = body
+        self._flush_body = flush_body
         self._add_pagebreak = False
         self._section = SectionPropertyManager(default_orient, sect_props)
         self._last_table_bottom_margin_index = None
+        self._fragment_records = []
 
     def add_pagebreak(self):
         self._add_pagebreak = True
@@ -599,7 +597,8 @@ class Document(object):
     def add_last_section_property(self):
         section_prop, no_title_page = self._section.get_last_section()
         section_prop = docx.copy_section_property(section_prop, no_title_page)
-        self._body.append(section_prop)
+        self._append_to_body(section_prop)
+        self._flush()
 
     def set_page_oriented(self, orient=None):
         self._section.rotate_to(orient)
@@ -625,11 +624,78 @@ class Document(object):
                 self._last_table_bottom_margin_index = len(self._body)
             else:
                 self._last_table_bottom_margin_index = None
+        self._append_to_body(xml)
+        self._flush()
+
+    def get_state(self):
+        """Return the state which affects the contents appended later"""
+        return (self._add_pagebreak,
+                self._last_table_bottom_margin_index is not None,
+                self._section.get_state())
+
+    def begin_fragment(self):
+        self._fragment_records.append(FragmentRecord(len(self._body)))
+
+    def end_fragment(self):
+        """Return the elements appended since the last begin_fragment call,
+        and information to reproduce the state changes in insert_fragment.
+        """
+        record = self._fragment_records.pop()
+        if self._last_table_bottom_margin_index is not None:
+            margin_index = len(self._body) - self._last_table_bottom_margin_index
+        else:
+            margin_index = None
+        end_state = (self._add_pagebreak, margin_index, self._section.get_state())
+        return (record.elements,
+                (record.removes_last_table_bottom_margin, end_state))
+
+    def insert_fragment(self, elements, state_info):
+        removes_last_table_bottom_margin, end_state = state_info
+        if removes_last_table_bottom_margin:
+            self._remove_last_table_bottom_margin_paragraph()
+        for xml in elements:
+            self._append_to_body(xml)
+        self._add_pagebreak, margin_index, section_state = end_state
+        self._section.set_state(section_state)
+        if margin_index is not None:
+            self._last_table_bottom_margin_index = len(self._body) - margin_index
+        else:
+            self._last_table_bottom_margin_index = None
+        self._flush()
+
+    def _append_to_body(self, xml):
         self._body.append(xml)
+        for record in self._fragment_records:
+            record.elements.append(xml)
+
+    def _flush(self):
+        # Elements from the last table bottom margin paragraph, which may be
+        # removed later, are kept in the body
+        if self._flush_body is None:
+            return
+        count = self._last_table_bottom_margin_index
+        if count is None:
+            count = len(self._body)
+        else:
+            self._last_table_bottom_margin_index = 0
+        if count == 0:
+            return
+        serialized = {}
+        for record in self._fragment_records:
+            record.serialize_flushed(count, serialized)
+            record.start -= count
+        self._flush_body(count)
 
     def _remove_last_table_bottom_margin_paragraph(self):
-        if self._last_table_bottom_margin_index is not None:
-            del self._body[self._last_table_bottom_margin_index]
+        index = self._last_table_bottom_margin_index
+        if index is not None:
+            del self._body[index]
+            for record in self._fragment_records:
+                if index >= record.start:
+                    del record.elements[index - record.start]
+                else:
+                    record.removes_last_table_bottom_margin = True
+                    record.start -= 1
         self._last_table_bottom_margin_index = None
 
     def _add_section_prop_if_necessary(self):
@@ -639,7 +705,7 @@ class Document(object):
         self._remove_last_table_bottom_margin_paragraph()
         section_prop, no_title_page = section
         section_prop = docx.copy_section_property(section_prop, no_title_page)
-        self._body.append(docx.make_section_prop_paragraph(section_prop))
+        self._append_to_body(docx.make_section_prop_paragraph(section_prop))
 
     @staticmethod
     def _is_table_bottom_margin_paragraph(contents):
@@ -663,12 +729,16 @@ class LiteralBlock(ParagraphElement):
 
     def to_xml(self):
         highlighted, style_id, indent, right_indent, keep_lines = self._args
-        highlighted = docx.fromstring(highlighted)[0]
         para = docx.make_paragraph(
             indent, right_indent, style_id, None,
             keep_lines, self._keep_next, None,
-            properties=docx.get_paragraph_properties(highlighted))
-        para.extend(docx.get_paragraph_contents(highlighted))
+            properties=[docx.make_paragraph_shading_property(
+                'clear', color='auto', fill=highlighted.background_color)])
+        for index, tokens in enumerate(highlighted.lines):
+            if index != 0:
+                para.append(docx.make_break_run())
+            para.extend(
+                docx.make_code_run(text, props) for text, props in tokens)
         return para
 
 class LiteralBlockTable(TableElement):
@@ -684,7 +754,6 @@ class LiteralBlockTable(TableElement):
 
     def to_xml(self):
         highlighted, top_space, style_id, table_width, indent = self._args
-        org_tbl = docx.fromstring(highlighted)[0]
         table = docx.make_table(
             None, table_width[1], indent, None,
             [table_width[0] * 0.1, table_width[0] * 0.9], False, True,
@@ -698,7 +767,10 @@ class LiteralBlockTable(TableElement):
             top=None, bottom=None, left=None, right=None)
         middle_border = docx.make_paragraph_border_property(
             top=None, bottom=None)
-        last_index = len(org_tbl) - 1
+        lineno_shading = docx.make_paragraph_shading_property('clear')
+        code_shading = docx.make_paragraph_shading_property(
+            'clear', color='auto', fill=highlighted.background_color)
+        last_index = len(highlighted.lines) - 1
         if last_index == 0:
             border = {0: docx.make_paragraph_border_property()}
         else:
@@ -707,7 +779,7 @@ class LiteralBlockTable(TableElement):
                 last_index: docx.make_paragraph_border_property(top=None),
             }
 
-        for index, org_row in enumerate(org_tbl):
+        for index, tokens in enumerate(highlighted.lines):
             row = docx.make_row(index, False, False, False, None)
             if index == 0:
                 spacing = docx.make_paragraph_spacing_property(
@@ -717,23 +789,22 @@ class LiteralBlockTable(TableElement):
             cell1 = docx.make_cell(
                 0, True, None, 1, None, False, no_wrap=True, valign='top')
             keep_next = self._is_keep_next(index)
-            para1_props = docx.get_paragraph_properties(org_row[0][0])
-            para1_props.extend([spacing, lineno_border])
             para1 = docx.make_paragraph(
                 None, None, style_id, 'right', False, keep_next, None,
-                properties=para1_props)
-            para1.extend(docx.get_paragraph_contents(org_row[0][0]))
+                properties=[lineno_shading, spacing, lineno_border])
+            para1.append(docx.make_code_run(
+                str(highlighted.linenostart + index), ()))
             cell1.append(para1)
             row.append(cell1)
 
             cell2 = docx.make_cell(
                 1, False, 0.99, 1, None, False, no_wrap=False, valign='top')
-            para2_props = docx.get_paragraph_properties(org_row[1][0])
-            para2_props.extend([no_spacing, border.get(index, middle_border)])
             para2 = docx.make_paragraph(
                 None, None, style_id, None, False, False, None,
-                properties=para2_props)
-            para2.extend(docx.get_paragraph_contents(org_row[1][0]))
+                properties=[
+                    code_shading, no_spacing, border.get(index, middle_border)])
+            para2.extend(
+                docx.make_code_run(text, props) for text, props in tokens)
             cell2.append(para2)
             row.append(cell2)
             table.append(row)
@@ -832,18 +903,16 @@ class DocxTranslator(nodes.NodeVisitor):
         nodes.NodeVisitor.__init__(self, document)
         self._builder = builder
         self.builder = self._builder # Needs for graphviz.render_dot
-        stylefile = builder.config['docx_style']
-        if stylefile:
-            stylefile = os.path.join(builder.confdir, os.path.join(stylefile))
-        else: # Use default style file
-            stylefile = os.path.join(
-                os.path.dirname(__file__), 'docx/style.docx')
-        self._docx = docx.DocxComposer(
-            stylefile, builder.config['docx_coverpage'])
+        self._docx = self._make_composer()
         default_orient, sect_props = self._docx.get_section_properties()
+        if builder.config.docx_streaming:
+            self._docx.start_body_stream()
+            flush_body = self._docx.flush_body
+        else:
+            flush_body = None
         self._doc_stack = []
-        self._doc_stack.append(
-            Document(self._docx.docbody, default_orient, sect_props))
+        self._doc_stack.append(Document(
+            self._docx.docbody, default_orient, sect_props, flush_body))
         self._docname_stack = []
         self._section_level = 0
         self._ctx_stack = [
@@ -860,14 +929,17 @@ class DocxTranslator(nodes.NodeVisitor):
         else:
             trim_doctest_flags = None
         self._highlighter = DocxPygmentsBridge(
-            'html', builder.config.pygments_style, trim_doctest_flags)
+            'html', builder.config.pygments_style, trim_doctest_flags,
+            builder.highlight_cache)
         self._numsec_map = builder.make_numsec_map()
         self._numfig_map = builder.make_numfig_map()
-        self._bookmark_id = self._docx.get_max_bookmark_id()
         self._bookmark_id_map = {} # bookmark name => BookmarkStart id
         self._logger = logging.getLogger('docxbuilder')
+        self._file_spans = [] # trace spans of start_of_file nodes
+        self._math_cache = builder.math_cache
+        self.fragments = FragmentManager(
+            self, self._numsec_map, self._numfig_map)
 
-        self._create_docxbuilder_styles()
         self._bullet_list_id = self._docx.get_bullet_list_num_id('List Bullet')
         bullet_list_indents = self._docx.get_numbering_left('List Bullet')
         if not bullet_list_indents:
@@ -881,8 +953,58 @@ class DocxTranslator(nodes.NodeVisitor):
             self._number_list_indent = number_list_indents[0]
         self._default_paragraph_style_stack = []
         self._append_default_paragraph_style('Body Text')
+        profiler = builder.visitor_profiler
+        if profiler is not None:
+            profiler.wrap(self, self._docname_stack)
+
+    def _make_composer(self):
+        # Composers are cloned from the template, on which the docxbuilder
+        # styles have been created, in order not to parse the style file
+        # for each document
+        stylefile = get_style_file_path(self._builder)
+        has_coverpage = self._builder.config['docx_coverpage']
+        templates = self._builder.composer_templates
+        key = (stylefile, has_coverpage)
+        template = templates.get(key)
+        if template is None:
+            with trace.span('load_style', stylefile=stylefile):
+                template = docx.DocxComposer(
+                    stylefile, has_coverpage, self._builder.image_cache,
+                    trace.span)
+                self._create_docxbuilder_styles(template)
+                template.get_section_properties()
+            templates[key] = template
+        with trace.span('clone_style'):
+            composer = template.clone()
+        return composer
 
     def asbytes(self):
+        image_files = self._resample_images()
+        with trace.span('write_package'):
+            return self._docx.asbytes(
+                self._builder.config.docx_update_fields,
+                self._get_properties(), image_files)
+
+    def save(self, filename):
+        config = self._builder.config
+        image_files = self._resample_images()
+        with trace.span('write_package', filename=filename):
+            self._docx.save(
+                filename, config.docx_update_fields, self._get_properties(),
+                config.docx_compression, image_files)
+
+    def _resample_images(self):
+        resampler = self._builder.image_resampler
+        if resampler is None:
+            return {}
+        with trace.span('resample_images'):
+            image_files, errors = resampler.resample(
+                self._docx.get_image_display_sizes())
+        for error in errors:
+            self._logger.warning('Failed to downscale image %s' % error)
+        return image_files
+
+    def _get_properties(self):
         props = self._builder.doc_properties
         props, invalids = docx.classify_properties(props)
         for key, reason in invalids.items():
@@ -891,7 +1013,7 @@ class DocxTranslator(nodes.NodeVisitor):
                 % (key, reason))
         props['core'].setdefault(
             'language', self._builder.config.language or 'en')
-        return self._docx.asbytes(self._builder.config.docx_update_fields, props)
+        return props
 
     def _get_custom_style(self, classes, style_type):
         custom_styles = self._builder.config.docx_style_names
@@ -927,9 +1049,9 @@ class DocxTranslator(nodes.NodeVisitor):
         docname = self._docname_stack[-1]
         for node_id in ids:
             name = make_bookmark_name(docname, node_id)
-            self._bookmark_id += 1
-            self._bookmark_id_map[name] = self._bookmark_id
-            self._doc_stack[-1].append(BookmarkStart(self._bookmark_id, name))
+            bookmark_id = self._docx.new_bookmark_id()
+            self._bookmark_id_map[name] = bookmark_id
+            self._doc_stack[-1].append(BookmarkStart(bookmark_id, name))
 
     def _append_bookmark_end(self, ids):
         docname = self._docname_stack[-1]
@@ -1105,7 +1227,7 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def _convert_math(self, latex, node):
         try:
-            return latex2omml(latex)
+            return self._math_cache.get(latex)
         except Exception as e: # pylint: disable=broad-except
             self._logger.warning(
                 'Failed to convert math %s: %s', latex, e, location=node)
@@ -1227,7 +1349,7 @@ class DocxTranslator(nodes.NodeVisitor):
                 raise RuntimeError('Failed to get filepath')
             width, height = self._get_image_scaled_size(node, filepath)
             rid = self._docx.add_image_relationship(
-                filepath, self._relationship_stack[-1])
+                filepath, self._relationship_stack[-1], (width, height))
             filename = os.path.basename(filepath)
             self._doc_stack[-1].add_picture(
                 rid, self._docx.new_id(), filename, width, height, alt)
@@ -1255,8 +1377,10 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def visit_math_block_node(self, node, latex):
         self._append_bookmark_start(node.get('ids', []))
-        equations = [
-            self._convert_math(eq, node) for eq in re.split(r'\n{2,}', latex)]
+        with trace.span('visit_math_block'):
+            equations = [
+                self._convert_math(eq, node)
+                for eq in re.split(r'\n{2,}', latex)]
         self._doc_stack[-1].append(MathBlock(
             equations,
             self._ctx_stack[-1].indent, self._ctx_stack[-1].right_indent,
@@ -1265,6 +1389,28 @@ class DocxTranslator(nodes.NodeVisitor):
         raise nodes.SkipNode
 
     def visit_start_of_file(self, node):
+        is_chapter_node = len(self._docname_stack) == 1
+        if is_chapter_node and not self.fragments.enter_chapter():
+            raise nodes.SkipNode
+        # The span is dropped without being ended if the node is skipped
+        span = trace.span('start_of_file', docname=node['docname'])
+        if node.get('docx_lazy') and not self._builder.load_start_of_file(node):
+            raise nodes.SkipNode
+        if (self.fragments.cache is not None and len(self._doc_stack) == 1
+                and isinstance(self._doc_stack[-1], Document)
+                and not has_lazy_start_of_file(node)):
+            key = self.fragments.make_key(node, self._get_fragment_state())
+            fragment = self.fragments.cache.get(key)
+            if fragment is not None and fragment.is_valid():
+                self._insert_fragment(fragment)
+                if node.get('docx_lazy'):
+                    node.children = []
+                span.end()
+                raise nodes.SkipNode
+            self.fragments.begin(node, key, is_chapter_node)
+            self._docx.begin_fragment()
+            self._doc_stack[-1].begin_fragment()
+        self.fragments.prepare_start_of_file(node, is_chapter_node)
         self._docname_stack.append(node['docname'])
         self._append_bookmark_start([''])
         config = self._builder.config
@@ -1272,11 +1418,43 @@ class DocxTranslator(nodes.NodeVisitor):
                 and isinstance(self._doc_stack[-1], Document)):
             self._doc_stack[-1].add_pagebreak()
         self._append_bookmark_start(node.get('ids', []))
+        self._file_spans.append(span)
 
     def depart_start_of_file(self, node):
         self._append_bookmark_end(node.get('ids', []))
         self._append_bookmark_end([''])
         self._docname_stack.pop()
+        key = self.fragments.end(node)
+        if key is not None:
+            elements, state_info = self._doc_stack[-1].end_fragment()
+            self.fragments.cache.put(key, TranslatedFragment(
+                self._docx.end_fragment(elements), state_info,
+                self._language, self._linenothreshold))
+        if node.get('docx_lazy'):
+            # Release the contents loaded by load_start_of_file
+            node.children = []
+        if len(self._docname_stack) == 1:
+            self.fragments.leave_chapter()
+        self._file_spans.pop().end()
+
+    def _insert_fragment(self, fragment):
+        elements = self._docx.insert_fragment(fragment.fragment)
+        self._doc_stack[-1].insert_fragment(elements, fragment.state_info)
+        self._language = fragment.language
+        self._linenothreshold = fragment.linenothreshold
+
+    def _get_fragment_state(self):
+        """Return the state of the translator which affects the fragments"""
+        ctx = self._ctx_stack[-1]
+        return (
+            self._doc_stack[-1].get_state(),
+            tuple(self._docname_stack), self._section_level,
+            (ctx.indent, ctx.right_indent, ctx.width, ctx.list_level),
+            tuple(self._list_id_stack), self._line_block_level,
+            self._language, self._linenothreshold,
+            self._relationship_stack[-1],
+            self._default_paragraph_style_stack[-1],
+        )
 
     def visit_Text(self, node): # pylint: disable=invalid-name
         self._doc_stack[-1].add_text(node.astext())
@@ -1285,6 +1463,8 @@ class DocxTranslator(nodes.NodeVisitor):
         pass
 
     def visit_document(self, node):
+        # The chapters replayed from the fragments are not prepared
+        self.fragments.prepare_document(node)
         self._docname_stack.append(node['docname'])
         self._append_bookmark_start([''])
 
@@ -2013,11 +2193,9 @@ class DocxTranslator(nodes.NodeVisitor):
     def visit_math(self, node):
         self._append_bookmark_start(node.get('ids', []))
         latex = node.get('latex', node.astext())
-        try:
-            self._doc_stack[-1].add_math(latex)
-        except Exception as e: # pylint: disable=broad-except
-            self._logger.warning(
-                'Failed to convert math %s: %s', latex, e, location=node)
+        with trace.span('visit_math'):
+            omml = self._convert_math(latex, node)
+        self._doc_stack[-1].add_math(omml)
         self._append_bookmark_end(node.get('ids', []))
         raise nodes.SkipNode
 
@@ -2465,13 +2643,18 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def visit_graphviz(self, node):
         def get_filepath(self, node):
-            _fname, filepath = graphviz.render_dot(
-                self, node['code'], node['options'], 'png')
+            filepath, error = self.fragments.get_graphviz_file(node)
+            if error is not None:
+                raise error
+            if filepath is None:
+                _fname, filepath = graphviz.render_dot(
+                    self, node['code'], node['options'], 'png')
             if filepath is None:
                 raise RuntimeError('Failed to generate a graphviz image')
             return filepath
-        self.visit_image_node(
-            node, node.get('alt', (node['code'], 'dot')), get_filepath)
+        with trace.span('visit_graphviz'):
+            self.visit_image_node(
+                node, node.get('alt', (node['code'], 'dot')), get_filepath)
 
     def visit_refcount(self, _node): # pylint: disable=no-self-use
         raise nodes.SkipNode # TODO
@@ -2523,12 +2706,12 @@ class DocxTranslator(nodes.NodeVisitor):
         height = self._get_cm_size(node, 'height')
 
         if width is None and height is None:
-            width, height = get_image_size(filename)
+            width, height = self._get_image_size(filename)
         elif width is None:
-            img_width, img_height = get_image_size(filename)
+            img_width, img_height = self._get_image_size(filename)
             width = img_width * height / img_height
         elif height is None:
-            img_width, img_height = get_image_size(filename)
+            img_width, img_height = self._get_image_size(filename)
             height = img_height * width / img_width
 
         scale = node.get('scale')
@@ -2546,6 +2729,9 @@ class DocxTranslator(nodes.NodeVisitor):
 
         return width, height
 
+    def _get_image_size(self, filename):
+        return self._builder.image_cache.get(filename).get_cm_size()
+
     def _get_cm_size(self, node, attr, max_width=0):
         try:
             return convert_to_cm_size(
@@ -2578,12 +2764,13 @@ class DocxTranslator(nodes.NodeVisitor):
                 self._get_bookmark_name(ref.get('refuri'))))
         return outlines
 
-    def _create_docxbuilder_styles(self):
-        self._docx.create_empty_paragraph_style('Transition', 100, True, False)
-        self._docx.create_empty_paragraph_style(
+    @staticmethod
+    def _create_docxbuilder_styles(composer):
+        composer.create_empty_paragraph_style('Transition', 100, True, False)
+        composer.create_empty_paragraph_style(
             DocxTranslator.TABLE_BOTTOM_MARGIN_STYLE_NAME, 0, False, True)
 
-        default_paragraph, _, default_table = self._docx.get_default_style_names()
+        default_paragraph, _, default_table = composer.get_default_style_names()
         paragraph_styles = [
             ('Body Text', default_paragraph, False, False),
             ('Footnote Text', default_paragraph, False, False),
@@ -2606,13 +2793,14 @@ class DocxTranslator(nodes.NodeVisitor):
             ('Subtitle Heading', 'Heading', True, True),
         ]
         for new_style, based_style, is_custom, is_hidden in paragraph_styles:
-            self._docx.create_style(
+            composer.create_style(
                 'paragraph', new_style, based_style, is_custom, is_hidden)
 
-        self._docx.create_list_style(
-            'List Bullet', 'bullet', '\uf0b7', 'Symbol', self._basic_indent)
-        self._docx.create_list_style(
-            'List Number', 'arabic', '%1.', None, self._basic_indent)
+        basic_indent = composer.get_indent('List Paragraph', 320)
+        composer.create_list_style(
+            'List Bullet', 'bullet', '\uf0b7', 'Symbol', basic_indent)
+        composer.create_list_style(
+            'List Number', 'arabic', '%1.', None, basic_indent)
 
         table_styles = [
             ('List Table', default_table, False, True),
@@ -2626,5 +2814,5 @@ class DocxTranslator(nodes.NodeVisitor):
             ('Admonition Versionmodified', 'Based Admonition', True, True),
         ]
         for new_style, based_style, is_custom, is_hidden in table_styles:
-            self._docx.create_style(
+            composer.create_style(
                 'table', new_style, based_style, is_custom, is_hidden)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 from distutils.command import build
 from setuptools import setup
 
@@ -12,10 +13,12 @@ class CustomBuild(build.build, object):
 BASEDIR = os.path.dirname(os.path.abspath(__file__))
 with open(os.path.join(BASEDIR, 'README.rst'), 'r') as f:
     LONG_DESCRIPTION = f.read()
+with open(os.path.join(BASEDIR, 'docxbuilder', 'version.py'), 'r') as f:
+    VERSION = re.search(r"^__version__ = '(.*)'", f.read(), re.M).group(1)
 
 setup(
     name='docxbuilder',
-    version='1.2.0',
+    version=VERSION,
     description='Sphinx docx builder extension',
     long_description=LONG_DESCRIPTION,
     url='https://github.com/amedama41/docxbuilder',
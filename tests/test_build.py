@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests that the options to speed up builds do not change the output.
+
+    A small project with some chapters is built with the default options
+    and with each option, and the canonicalized word/document.xml of
+    the docx files are compared.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+from lxml import etree
+from sphinx.application import Sphinx
+from sphinx.util.docutils import docutils_namespace
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BASE_DIR)
+
+# pylint: disable=wrong-import-position
+from create_style_file import create_style_file
+
+STYLE_FILE = os.path.join(BASE_DIR, 'docxbuilder', 'docx', 'style.docx')
+
+CONF = '''
+extensions = ['docxbuilder']
+project = 'test'
+docx_documents = [('index', 'test.docx', {'title': 'Test'}, False)]
+'''
+
+INDEX = '''
+Test
+====
+
+.. toctree::
+   :numbered:
+
+%s
+'''
+
+CHAPTER = '''
+Chapter %(index)d
+==========
+
+Paragraph of chapter %(index)d with *emphasis*, ``literal`` and
+a reference to :ref:`section-%(index)d`.
+
+* item 1
+* item 2
+
+  1. nested item
+  2. nested item
+
+.. _section-%(index)d:
+
+Section %(index)d
+----------
+
+.. code-block:: python
+
+   print(%(index)d)
+
+Footnote [#f%(index)d]_.
+
+.. [#f%(index)d] Footnote of chapter %(index)d.
+'''
+
+TABLE = '''
+.. list-table::
+
+   * - cell 1
+     - cell 2
+'''
+
+NUM_CHAPTERS = 4
+
+DOCUMENTS = [
+    ('index', 'test.docx', {'title': 'Test'}, False),
+    ('chapter0', 'chapter0.docx', {'title': 'Chapter'}, False),
+]
+
+def write_file(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+
+def make_project(srcdir):
+    write_file(os.path.join(srcdir, 'conf.py'), CONF)
+    names = []
+    for index in range(NUM_CHAPTERS):
+        name = 'chapter%d' % index
+        contents = CHAPTER % {'index': index}
+        if index == 1:
+            # The next chapter starts in a different state after the table
+            contents += TABLE
+        write_file(os.path.join(srcdir, name + '.rst'), contents)
+        names.append(name)
+    write_file(
+        os.path.join(srcdir, 'index.rst'),
+        INDEX % '\n'.join('   ' + name for name in names))
+
+def read_document_xml(filename):
+    with zipfile.ZipFile(filename) as docx:
+        root = etree.fromstring(docx.read('word/document.xml'))
+    return etree.tostring(root, method='c14n')
+
+
+class BuildTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if not os.path.exists(STYLE_FILE):
+            create_style_file()
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.srcdir = os.path.join(cls.tmpdir, 'src')
+        os.makedirs(cls.srcdir)
+        make_project(cls.srcdir)
+        cls.expected = cls.build('default', {})
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    @classmethod
+    def build(cls, name, confoverrides):
+        outdir = os.path.join(cls.tmpdir, name)
+        # The nodes registered by a build are unregistered for the next one
+        with docutils_namespace():
+            app = Sphinx(
+                cls.srcdir, cls.srcdir, outdir,
+                os.path.join(outdir, '.doctrees'), 'docx', confoverrides,
+                status=None, warning=None)
+            app.build(force_all=True)
+        return read_document_xml(os.path.join(outdir, 'test.docx'))
+
+    def test_fragment_cache(self):
+        options = {'docx_fragment_cache': True}
+        self.assertEqual(self.build('fragment', options), self.expected)
+        cachefile = os.path.join(
+            self.tmpdir, 'fragment', '.doctrees', 'docx_fragments.pickle')
+        self.assertTrue(os.path.exists(cachefile))
+        # The second build inserts the cached fragments
+        self.assertEqual(self.build('fragment', options), self.expected)
+
+    def test_streaming(self):
+        options = {'docx_streaming': True}
+        self.assertEqual(self.build('streaming', options), self.expected)
+
+    def test_lazy_assembly(self):
+        options = {'docx_lazy_assembly': True}
+        self.assertEqual(self.build('lazy', options), self.expected)
+
+    def test_parallel_chapters(self):
+        options = {'docx_parallel_chapters': True, 'docx_parallel_jobs': 2}
+        self.assertEqual(self.build('parallel', options), self.expected)
+
+    def test_parallel_documents(self):
+        serial = {'docx_documents': DOCUMENTS, 'docx_parallel_jobs': 1}
+        parallel = {'docx_documents': DOCUMENTS, 'docx_parallel_jobs': 2}
+        self.assertEqual(
+            self.build('documents_parallel', parallel),
+            self.build('documents_serial', serial))
+        # Check the other document written in another process
+        self.assertEqual(
+            read_document_xml(os.path.join(
+                self.tmpdir, 'documents_parallel', 'chapter0.docx')),
+            read_document_xml(os.path.join(
+                self.tmpdir, 'documents_serial', 'chapter0.docx')))
+
+
+if __name__ == '__main__':
+    unittest.main()